@@ -1,15 +1,14 @@
 """A utility class to interface with DynamoDB."""
-import boto3
 from boto3.dynamodb.conditions import Key
 
+from shared.awsclients import get_client, get_resource
+
 
 class DynamodbAPI:
     def __init__(self, region_name):
         self.region_name = region_name
-        self.dynamodb_resource = boto3.resource(
-            "dynamodb", region_name=self.region_name
-        )
-        self.dynamodb_client = boto3.client("dynamodb", region_name=self.region_name)
+        self.dynamodb_resource = get_resource("dynamodb", region_name=self.region_name)
+        self.dynamodb_client = get_client("dynamodb", region_name=self.region_name)
 
     def get_table_list(self):
         """Return a list all tables in the dynamoDB."""
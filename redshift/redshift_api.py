@@ -1,12 +1,65 @@
+"""Query helpers for Redshift.
+
+The queries run on pooled connections: opening a Redshift connection
+costs a password lookup and a TLS handshake, so connections are kept
+open and reused. A pooled connection is checked before it is handed
+out and closed once it stays idle for too long, so a query never
+lands on a connection the cluster dropped in the meantime.
+
+Every connection parameter left to None is read from the PGHOST,
+PGPORT and PGDATABASE environment variables, and the password from
+the .pgpass file or PGPASSWORD, which lets the pool and the queries
+run against a local PostgreSQL too.
+
+Example:
+```
+pool = get_pool(user="etl", host_add="redshift.example.com", dbname="dev", port=5439)
+with pool.connection() as conn:
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1")
+df = run_query("etl", "SELECT * FROM events WHERE day = %s", "2020-01-01", pool=pool)
+```
+
+Against a local PostgreSQL, e.g. for tests:
+```
+df = run_query("postgres", "SELECT 1 AS a", host_add="localhost", port=5432)
+```
+or with PGHOST=localhost PGPORT=5432 PGDATABASE=postgres exported,
+`run_query("postgres", "SELECT 1 AS a")`.
+"""
+
+import collections
+import contextlib
+import functools
 import logging
+import os
+import threading
+import time
 
 import pandas as pd
 import pgpasslib
 import psycopg2
+import psycopg2.extensions
 
 from shared.etlexceptions import BaseExpTaskException
 
 
+@functools.lru_cache(maxsize=64)
+def _get_password(host_add, port, dbname, user):
+    # pgpasslib parses the .pgpass file on every call, and unlike
+    # libpq it neither reads the PG* variables nor accepts a None port
+    try:
+        return pgpasslib.getpass(
+            host=host_add or os.environ.get("PGHOST", "localhost"),
+            port=port or os.environ.get("PGPORT", 5432),
+            dbname=dbname or os.environ.get("PGDATABASE", user),
+            user=user,
+        )
+    except pgpasslib.FileNotFound:
+        # libpq falls back to PGPASSWORD or a login without password
+        return None
+
+
 def connect_to_redshift(
     host_add=None,
     dbname=None,
@@ -39,7 +92,7 @@ def connect_to_redshift(
 
     # get password
     if pwd is None:
-        pwd = pgpasslib.getpass(host=host_add, port=port, dbname=dbname, user=user)
+        pwd = _get_password(host_add, port, dbname, user)
 
     # connect to redshift with fixed user / password
     try:
@@ -51,77 +104,423 @@ def connect_to_redshift(
     except Exception as err:
         logging.error(
             "Unable to connect to the database with error {} of error_code: {}".format(
-                err, err.code
+                err, getattr(err, "pgcode", None)
             )
         )
 
     raise (BaseExpTaskException("Error in fetching the Redshift Connection"))
 
 
-def run_query_from_file(user, script, *args):
-    """Return dataframe of a single SQL Query
-    Run single SQL Query with parameters subsitution
+class RedshiftConnectionPool(object):
+    """
+    A thread safe pool of Redshift connections.
 
-    parameters
-    ----------
+    Up to max_size connections are open at a time, a checkout waits
+    up to timeout seconds for one to be returned. Returned
+    connections beyond min_size are closed after idle_timeout
+    seconds, and every connection after max_lifetime seconds.
+    A connection idle for more than check_after seconds is pinged
+    with SELECT 1 on checkout and replaced when the ping fails.
+
+    A forked process never reuses the connections of its parent,
+    they share the same socket.
+    """
+
+    def __init__(
+        self,
+        min_size=1,
+        max_size=10,
+        idle_timeout=300,
+        max_lifetime=3600,
+        check_after=5,
+        timeout=30,
+        host_add=None,
+        dbname=None,
+        user=None,
+        port=None,
+        pwd=None,
+    ):
+
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError("Expected 0 <= min_size <= max_size and max_size >= 1")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        self.timeout = timeout
+        self._connect_kwargs = dict(
+            host_add=host_add, dbname=dbname, user=user, port=port, pwd=pwd
+        )
+        self._cond = threading.Condition()
+        # (connection, opened at, returned at), the most recent last
+        self._idle = collections.deque()
+        self._size = 0
+        self._closed = False
+        self._pid = os.getpid()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def size(self):
+        """The number of open connections, idle or checked out."""
+        return self._size
+
+    @property
+    def idle(self):
+        """The number of idle connections."""
+        return len(self._idle)
+
+    def _check_fork(self):
+
+        if self._pid != os.getpid():
+            # closing would terminate the parent's sessions
+            self._idle.clear()
+            self._size = 0
+            self._pid = os.getpid()
+
+    def _connect(self):
+
+        conn = connect_to_redshift(**self._connect_kwargs)
+        return conn, time.monotonic()
+
+    @staticmethod
+    def _discard(conn):
+
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_alive(self, conn, returned_at):
+        """
+        Returns True when the connection is usable, pings it when it
+        was idle for more than check_after seconds.
+        """
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchall()
+            conn.rollback()
+            return True
+        except psycopg2.Error as err:
+            logging.warning("Dropping a dead Redshift connection: {}".format(err))
+            return False
+
+    def _expire_idle(self, now):
+        """
+        Pops the idle connections past idle_timeout or max_lifetime,
+        to close outside of the lock.
+        """
+        expired = []
+        kept = collections.deque()
+        for entry in self._idle:
+            conn, opened_at, returned_at = entry
+            stale = now - returned_at > self.idle_timeout
+            if now - opened_at > self.max_lifetime or (
+                stale and self._size - len(expired) > self.min_size
+            ):
+                expired.append(conn)
+            else:
+                kept.append(entry)
+        self._idle = kept
+        self._size -= len(expired)
+        return expired
+
+    def _checkout(self):
+
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                self._check_fork()
+                if self._closed:
+                    raise BaseExpTaskException("The Redshift connection pool is closed")
+                expired = self._expire_idle(time.monotonic())
+                entry = None
+                if self._idle:
+                    entry = self._idle.pop()
+                elif self._size < self.max_size:
+                    # reserve the slot, connect outside of the lock
+                    self._size += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise BaseExpTaskException(
+                            "No Redshift connection available after {}s".format(
+                                self.timeout
+                            )
+                        )
+                    self._cond.wait(remaining)
+                    continue
+
+            for conn in expired:
+                self._discard(conn)
+
+            if entry is None:
+                try:
+                    return self._connect()
+                except BaseException:
+                    self._release_slot()
+                    raise
+
+            conn, opened_at, returned_at = entry
+            if self._is_alive(conn, returned_at):
+                return conn, opened_at
+            self._discard(conn)
+            self._release_slot()
+
+    def _release_slot(self):
+
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _checkin(self, conn, opened_at, failed):
+        """
+        Ends the transaction of the connection and returns it to the
+        pool, or closes it when it can not be reused.
+        """
+        reusable = not conn.closed
+        if reusable:
+            try:
+                status = conn.info.transaction_status
+                if failed or status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                reusable = False
+
+        now = time.monotonic()
+        with self._cond:
+            if self._pid != os.getpid():
+                # checked out before a fork, the parent owns it
+                return
+            if reusable and not self._closed and now - opened_at <= self.max_lifetime:
+                self._idle.append((conn, opened_at, now))
+                self._cond.notify()
+                return
+            self._size -= 1
+            self._cond.notify()
+        self._discard(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the with block. The transaction
+        left open by the block is rolled back when the connection is
+        returned, commit explicitly to keep changes.
+
+        Example:
+        ```
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("INSERT INTO events VALUES (%s)", (1,))
+            conn.commit()
+        ```
+        """
+        conn, opened_at = self._checkout()
+        failed = True
+        try:
+            yield conn
+            failed = False
+        finally:
+            self._checkin(conn, opened_at, failed)
+
+    def fill(self):
+        """
+        Opens connections up to min_size.
+        """
+        while True:
+            with self._cond:
+                self._check_fork()
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn, opened_at = self._connect()
+            except BaseException:
+                self._release_slot()
+                raise
+            with self._cond:
+                self._idle.append((conn, opened_at, time.monotonic()))
+                self._cond.notify()
+
+    def close(self):
+        """
+        Closes the idle connections, the checked out ones are closed
+        when they are returned.
+        """
+        with self._cond:
+            self._check_fork()
+            self._closed = True
+            idle = [entry[0] for entry in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+
+_pools_lock = threading.Lock()
+_pools = {}
+
+
+def get_pool(user, host_add=None, dbname=None, port=None, pwd=None, **pool_kwargs):
+    """
+    Returns the shared connection pool of the connection parameters,
+    created on first use with the pool_kwargs, see
+    RedshiftConnectionPool, and filled up to its min_size.
+
+    parameters:
+    -----------
     user: redshift user id
-    script: SQL query script in a file
-    *args: list of parameters used in the SQL query
+    host_add: redshift host
+    dbname: redshift database name
+    port: redshift port name
+    pwd: redshift user password
+    """
+    key = (host_add, port, dbname, user)
+    with _pools_lock:
+        pool = _pools.get(key)
+        created = pool is None or pool._closed
+        if created:
+            pool = RedshiftConnectionPool(
+                host_add=host_add,
+                dbname=dbname,
+                user=user,
+                port=port,
+                pwd=pwd,
+                **pool_kwargs
+            )
+            _pools[key] = pool
+    if created:
+        # connect outside of the lock, the other pools stay available
+        pool.fill()
+    return pool
 
-    return
-    ------
-    Query results in a panda dataframe
+
+def close_pools():
+    """
+    Closes every shared connection pool and forgets the cached
+    passwords, e.g. after a password rotation.
     """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+    _get_password.cache_clear()
 
-    # redshift connection
-    conn = connect_to_redshift(user=user)
-    cur = conn.cursor()
 
-    f = open(script, "r")
-    query = f.read()
+def _execute_query(conn, query, args):
 
     try:
-        cur.execute(query, args)
-        rows = cur.fetchall()
-        colnames = [desc[0] for desc in cur.description]
+        with conn.cursor() as cur:
+            cur.execute(query, args)
+            rows = cur.fetchall()
+            colnames = [desc[0] for desc in cur.description]
         df = pd.DataFrame(rows, columns=colnames)
         logging.info("Completed Query Data")
         logging.info("-----------------------------------")
-        cur = None
         return df
     except psycopg2.Error as e:
         logging.error("Unable to run Query!")
         logging.error(e.pgerror)
+        conn.rollback()
+
+
+def _run_query(user, query, args, pooled, pool, connect_kwargs):
 
+    if pool is None and not pooled:
+        conn = connect_to_redshift(user=user, **connect_kwargs)
+        try:
+            return _execute_query(conn, query, args)
+        finally:
+            conn.close()
 
-def run_query(user, query, *args):
+    if pool is None:
+        pool = get_pool(user, **connect_kwargs)
+    with pool.connection() as conn:
+        return _execute_query(conn, query, args)
+
+
+def run_query_from_file(
+    user,
+    script,
+    *args,
+    pooled=True,
+    pool=None,
+    host_add=None,
+    dbname=None,
+    port=None,
+    pwd=None
+):
     """Return dataframe of a single SQL Query
     Run single SQL Query with parameters subsitution
 
     parameters
     ----------
     user: redshift user id
-    query: SQL query in string
+    script: SQL query script in a file
     *args: list of parameters used in the SQL query
+    pooled: a flag indicates whether to run on a shared pool connection
+    pool: a RedshiftConnectionPool to run on, e.g. from get_pool,
+          its connection parameters are used instead of the others
+    host_add: redshift host
+    dbname: redshift database name
+    port: redshift port name
+    pwd: redshift user password
 
     return
     ------
     Query results in a panda dataframe
     """
 
-    # reshift connection
-    conn = connect_to_redshift(user=user)
-    cur = conn.cursor()
+    with open(script, "r") as f:
+        query = f.read()
 
-    try:
-        cur.execute(query, args)
-        rows = cur.fetchall()
-        colnames = [desc[0] for desc in cur.description]
-        df = pd.DataFrame(rows, columns=colnames)
-        logging.info("Completed Query Data")
-        logging.info("-----------------------------------")
-        cur = None
-        return df
-    except psycopg2.Error as e:
-        logging.error("Unable to run Query!")
-        logging.error(e.pgerror)
+    connect_kwargs = dict(host_add=host_add, dbname=dbname, port=port, pwd=pwd)
+    return _run_query(user, query, args, pooled, pool, connect_kwargs)
+
+
+def run_query(
+    user,
+    query,
+    *args,
+    pooled=True,
+    pool=None,
+    host_add=None,
+    dbname=None,
+    port=None,
+    pwd=None
+):
+    """Return dataframe of a single SQL Query
+    Run single SQL Query with parameters subsitution
+
+    parameters
+    ----------
+    user: redshift user id
+    query: SQL query in string
+    *args: list of parameters used in the SQL query
+    pooled: a flag indicates whether to run on a shared pool connection
+    pool: a RedshiftConnectionPool to run on, e.g. from get_pool,
+          its connection parameters are used instead of the others
+    host_add: redshift host
+    dbname: redshift database name
+    port: redshift port name
+    pwd: redshift user password
+
+    return
+    ------
+    Query results in a panda dataframe
+    """
+
+    connect_kwargs = dict(host_add=host_add, dbname=dbname, port=port, pwd=pwd)
+    return _run_query(user, query, args, pooled, pool, connect_kwargs)
@@ -0,0 +1,547 @@
+import io
+import itertools
+import json
+import os
+import threading
+import time
+
+import fastavro
+import numpy as np
+import pandas as pd
+
+# numpy dtypes of the avro primitives that have a fixed width.
+# nullable variants fall back to the pandas masked dtypes.
+avro_numpy_dtypes = {
+    "boolean": ("bool", "boolean"),
+    "int": ("int32", "Int32"),
+    "long": ("int64", "Int64"),
+    "float": ("float32", "float32"),
+    "double": ("float64", "float64"),
+}
+
+# the unit of the encoded value of each timestamp logical type
+timestamp_logical_types = {
+    "timestamp-millis": "ms",
+    "timestamp-micros": "us",
+    "local-timestamp-millis": "ms",
+    "local-timestamp-micros": "us",
+    "date": "D",
+}
+
+
+def load_avro_schema(schema):
+    """
+    Returns the avro schema as a dict.
+
+    parameters:
+    -----------
+    schema: a schema file name or an already loaded schema dict,
+            files are loaded through the schema registry
+
+    return
+    ------
+    the schema dict, shared with the registry so it must not be changed
+    """
+    if isinstance(schema, dict):
+        return schema
+    return schema_registry.get(schema).schema
+
+
+def project_schema(schema, columns=None):
+    """
+    Returns a reader schema that only has the given columns, so
+    fastavro skips the other fields instead of decoding them.
+
+    parameters:
+    -----------
+    schema: a schema file name or schema dict
+    columns: a list of column names, None keeps every column
+
+    return
+    ------
+    the projected schema dict
+    """
+    schema = load_avro_schema(schema)
+    if columns is None:
+        return schema
+
+    fields = {f["name"]: f for f in schema["fields"]}
+    missing = [c for c in columns if c not in fields]
+    if missing:
+        raise ValueError("Columns {} are not in the schema".format(missing))
+    projected = dict(schema)
+    projected["fields"] = [fields[c] for c in columns]
+    return projected
+
+
+def _split_nullable(avro_type):
+    """
+    Returns (type, nullable) for a field type, unwrapping
+    the ["null", type] union that optional fields use.
+    """
+    if isinstance(avro_type, list):
+        non_null = [t for t in avro_type if t != "null"]
+        if len(non_null) == 1:
+            return non_null[0], len(non_null) < len(avro_type)
+    return avro_type, False
+
+
+def avro_dtype_map(schema, columns=None):
+    """
+    Returns the pandas dtype of each column of the schema.
+
+    parameters:
+    -----------
+    schema: a schema file name or schema dict
+    columns: a list of column names, None keeps every column
+
+    return
+    ------
+    a dict of column name to dtype
+    """
+    dtypes = {}
+    for field in project_schema(schema, columns)["fields"]:
+        dtypes[field["name"]] = _ColumnType(field["type"]).dtype
+    return dtypes
+
+
+class _ColumnType(object):
+    """
+    The pandas dtype of a field type, and the conversion of the
+    values of a column, for a chunk of rows at once, into a series
+    of that dtype without any type inference.
+    """
+
+    def __init__(self, avro_type):
+
+        avro_type, self._nullable = _split_nullable(avro_type)
+        self._kind = "object"
+        logical_type = None
+        if isinstance(avro_type, dict):
+            logical_type = avro_type.get("logicalType")
+            if avro_type["type"] == "enum":
+                self._kind = "enum"
+            else:
+                avro_type = avro_type["type"]
+
+        if logical_type in timestamp_logical_types:
+            self._kind = "timestamp"
+            self._unit = timestamp_logical_types[logical_type]
+            self.dtype = "datetime64[ns, UTC]"
+        elif self._kind == "enum":
+            self.dtype = pd.CategoricalDtype(avro_type["symbols"])
+        elif isinstance(avro_type, str) and avro_type in avro_numpy_dtypes:
+            self._kind = "numeric"
+            self._numpy_dtype, nullable_dtype = avro_numpy_dtypes[avro_type]
+            self.dtype = nullable_dtype if self._nullable else self._numpy_dtype
+        else:
+            self.dtype = "object"
+
+    def decode_default(self, default):
+        """
+        Returns the decoded value of a field default, which the
+        schema holds in its encoded form.
+        """
+        if self._kind == "timestamp" and isinstance(default, int):
+            return pd.Timestamp(default, unit=self._unit, tz="UTC")
+        return default
+
+    def to_series(self, values, name):
+        """
+        Returns a series of the column's dtype from a list of values.
+        """
+        if self._kind == "numeric":
+            # numpy turns None into nan for the float dtypes
+            if not self._nullable or self.dtype in ("float32", "float64"):
+                return pd.Series(np.array(values, dtype=self._numpy_dtype), name=name)
+            mask = np.array([value is None for value in values], dtype=bool)
+            if mask.any():
+                values = [False if value is None else value for value in values]
+            values = np.array(values, dtype=self._numpy_dtype)
+            if self.dtype == "boolean":
+                array = pd.arrays.BooleanArray(values, mask)
+            else:
+                array = pd.arrays.IntegerArray(values, mask)
+            return pd.Series(array, name=name)
+
+        if self._kind == "enum":
+            return pd.Series(pd.Categorical(values, dtype=self.dtype), name=name)
+
+        if self._kind == "timestamp":
+            # fastavro already decoded them into datetime objects
+            return pd.Series(pd.to_datetime(values, utc=True), name=name).astype(
+                self.dtype
+            )
+
+        array = np.empty(len(values), dtype=object)
+        # element wise, a list of lists must not become 2d
+        for row, value in enumerate(values):
+            array[row] = value
+        return pd.Series(array, name=name)
+
+
+class ColumnarAvroDecoder(object):
+    """
+    Decodes avro records into typed columns, driven by the table's
+    avro schema instead of pandas type inference. Records are read
+    chunk_size at a time, and each column of a chunk is converted in
+    a single vectorized call: enums become categoricals, ints and
+    floats get their numpy dtypes and timestamps become datetime64.
+    Columns that are not projected are skipped by fastavro and never
+    materialized.
+    """
+
+    def __init__(self, schema, columns=None, chunk_size=65536):
+
+        if isinstance(schema, dict):
+            self._schema = project_schema(schema, columns)
+            self._parsed_schema = fastavro.parse_schema(self._schema)
+        else:
+            entry = schema_registry.get(schema)
+            self._schema, self._parsed_schema = entry.projection(columns)
+        # a reader schema makes fastavro resolve every record against
+        # it, which doubles the decode time, so it is only used to
+        # skip the fields that are not projected
+        self._reader_schema = None if columns is None else self._parsed_schema
+        self._columns = [f["name"] for f in self._schema["fields"]]
+        self._types = [_ColumnType(f["type"]) for f in self._schema["fields"]]
+        self._chunk_size = chunk_size
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def schema(self):
+        return self._schema
+
+    def _make_frame(self, records, defaults):
+
+        series = {}
+        for name, column_type in zip(self._columns, self._types):
+            if name in defaults:
+                values = [defaults[name]] * len(records)
+            else:
+                values = [record.get(name) for record in records]
+            series[name] = column_type.to_series(values, name)
+        return pd.DataFrame(series, columns=self._columns)
+
+    def iterate(self, records, chunked=True, defaults=None):
+        """
+        Return a generator of dataframes built from an iterator of
+        decoded records. With chunked, every dataframe has at most
+        chunk_size rows, otherwise a single dataframe is yielded.
+        defaults holds the decoded value of the columns that are
+        missing from every record.
+        """
+        defaults = defaults or {}
+        records = iter(records)
+        frames = []
+        while True:
+            chunk = list(itertools.islice(records, self._chunk_size))
+            if chunk:
+                if chunked:
+                    yield self._make_frame(chunk, defaults)
+                else:
+                    frames.append(self._make_frame(chunk, defaults))
+            if len(chunk) < self._chunk_size:
+                break
+
+        if not chunked:
+            if not frames:
+                yield self._make_frame([], defaults)
+            elif len(frames) == 1:
+                yield frames[0]
+            else:
+                yield pd.concat(frames, ignore_index=True)
+
+    def decode(self, fo, chunked=True):
+        """
+        Return a generator of dataframes decoded from an avro
+        container file object. A column missing from the file's
+        writer schema, e.g. a field added since the file was written,
+        gets the default of its field as avro schema resolution
+        does; a ValueError is raised when the field has no default.
+        """
+        reader = fastavro.reader(fo, reader_schema=self._reader_schema)
+        defaults = {}
+        if self._reader_schema is None:
+            written = {f["name"] for f in reader.writer_schema["fields"]}
+            for field, column_type in zip(self._schema["fields"], self._types):
+                if field["name"] in written:
+                    continue
+                if "default" not in field:
+                    raise ValueError(
+                        "Field {} is not in the file and has no default".format(
+                            field["name"]
+                        )
+                    )
+                defaults[field["name"]] = column_type.decode_default(field["default"])
+        return self.iterate(reader, chunked, defaults)
+
+    def read(self, fo):
+        """
+        Decodes an avro container file object into one dataframe.
+        """
+        return next(self.decode(fo, chunked=False))
+
+
+class SchemaEntry(object):
+    """
+    A schema file loaded once: the schema dict, its fastavro
+    parsed form, the column list, the dtype map and the parsed
+    projections asked for so far.
+    """
+
+    def __init__(self, schema, mtime):
+
+        self.schema = schema
+        self.mtime = mtime
+        self.parsed = fastavro.parse_schema(schema)
+        self.columns = [f["name"] for f in schema["fields"]]
+        self.dtypes = avro_dtype_map(schema)
+        self.checked_at = time.monotonic()
+        self._projections = {}
+
+    def projection(self, columns=None):
+        """
+        Returns the projected schema dict and its parsed form.
+        """
+        if columns is None:
+            return self.schema, self.parsed
+        key = tuple(columns)
+        if key not in self._projections:
+            projected = project_schema(self.schema, columns)
+            self._projections[key] = (projected, fastavro.parse_schema(projected))
+        return self._projections[key]
+
+
+class SchemaRegistry(object):
+    """
+    Loads each avro schema file once and keeps its parsed form.
+    An entry is reloaded when the file's mtime changes, which is
+    checked at most once every check_interval seconds.
+    """
+
+    def __init__(self, check_interval=5.0):
+
+        self._check_interval = check_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, schema_file):
+        """
+        Returns the SchemaEntry of the schema file.
+        """
+        with self._lock:
+            entry = self._entries.get(schema_file)
+            now = time.monotonic()
+            if entry is not None and now - entry.checked_at < self._check_interval:
+                return entry
+
+            mtime = os.stat(schema_file).st_mtime
+            if entry is None or entry.mtime != mtime:
+                with open(schema_file, "r") as fin:
+                    entry = SchemaEntry(json.load(fin), mtime)
+                self._entries[schema_file] = entry
+            entry.checked_at = now
+            return entry
+
+    def invalidate(self, schema_file=None):
+        """
+        Drops the entry of the schema file, or every entry.
+        """
+        with self._lock:
+            if schema_file is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(schema_file, None)
+
+
+# the process wide schema registry
+schema_registry = SchemaRegistry()
+
+
+AVRO_MAGIC = b"Obj\x01"
+SYNC_SIZE = 16
+
+
+class RangeReader(object):
+    """
+    A forward only reader over an object that is fetched in byte
+    ranges. read_range(offset, length) returns the bytes of the
+    range, fewer at the end of the object.
+    """
+
+    def __init__(self, read_range, offset=0, fetch_size=8 * 1024 * 1024):
+
+        self._read_range = read_range
+        self._fetch_size = fetch_size
+        self._buf = b""
+        self._pos = 0
+        # absolute offset of self._buf[0]
+        self._base = offset
+        self._eof = False
+
+    def tell(self):
+        return self._base + self._pos
+
+    def _fill(self):
+
+        if self._eof:
+            return False
+        data = self._read_range(self._base + len(self._buf), self._fetch_size)
+        if not data:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos :] + data
+        self._base += self._pos
+        self._pos = 0
+        return True
+
+    def read(self, size):
+
+        while len(self._buf) - self._pos < size and self._fill():
+            pass
+        data = self._buf[self._pos : self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def read_long(self):
+        """
+        Reads one zigzag encoded avro long.
+        """
+        shift = 0
+        value = 0
+        while True:
+            byte = self.read(1)
+            if not byte:
+                raise EOFError("Unexpected end of the avro object")
+            value |= (byte[0] & 0x7F) << shift
+            if not byte[0] & 0x80:
+                return (value >> 1) ^ -(value & 1)
+            shift += 7
+
+    def skip_past(self, marker):
+        """
+        Moves right after the next occurrence of marker, returns
+        False when the end of the object is reached first.
+        """
+        while True:
+            idx = self._buf.find(marker, self._pos)
+            if idx >= 0:
+                self._pos = idx + len(marker)
+                return True
+            # keep a tail in case the marker straddles two fetches
+            self._pos = max(self._pos, len(self._buf) - len(marker) + 1)
+            if not self._fill():
+                return False
+
+
+def read_avro_header(read_range):
+    """
+    Reads the header of an avro container file.
+
+    parameters:
+    -----------
+    read_range: a function(offset, length) returning the bytes
+                of a range of the file
+
+    return
+    ------
+    the raw header bytes and the sync marker
+    """
+    reader = RangeReader(read_range, fetch_size=64 * 1024)
+    if reader.read(len(AVRO_MAGIC)) != AVRO_MAGIC:
+        raise ValueError("cannot read header - is it an avro file?")
+
+    # the metadata is an avro map of string to bytes
+    while True:
+        count = reader.read_long()
+        if count == 0:
+            break
+        if count < 0:
+            count = -count
+            reader.read_long()
+        for _ in range(2 * count):
+            reader.read(reader.read_long())
+    sync_marker = reader.read(SYNC_SIZE)
+    header_size = reader.tell()
+    reader = RangeReader(read_range, fetch_size=header_size)
+    return reader.read(header_size), sync_marker
+
+
+def read_avro_blocks(read_range, sync_marker, start, stop, fetch_size=None):
+    """
+    Returns the raw bytes of the data blocks that start in the
+    [start, stop) byte range of an avro container file. Unless
+    start is the end of the header, the range is scanned for the
+    first sync marker, since a block starts right after one.
+    Blocks that start in the range are read up to their end.
+
+    parameters:
+    -----------
+    read_range: a function(offset, length) returning the bytes
+                of a range of the file
+    sync_marker: the sync marker of the file
+    start: the range start offset, or the header size
+    stop: the range end offset
+    fetch_size: the size of the ranged reads
+
+    return
+    ------
+    the raw block bytes, each block ending with the sync marker
+    """
+    fetch_size = fetch_size or min(8 * 1024 * 1024, max(stop - start, 64 * 1024))
+    reader = RangeReader(read_range, max(start - SYNC_SIZE, 0), fetch_size)
+    if not reader.skip_past(sync_marker):
+        return b""
+
+    blocks = []
+    while reader.tell() < stop:
+        block_start = reader.tell()
+        try:
+            count = reader.read_long()
+        except EOFError:
+            break
+        size = reader.read_long()
+        data = reader.read(size + SYNC_SIZE)
+        if len(data) < size + SYNC_SIZE or data[-SYNC_SIZE:] != sync_marker:
+            raise ValueError("Corrupt avro block at offset {}".format(block_start))
+        blocks.append(encode_long(count) + encode_long(size) + data)
+    return b"".join(blocks)
+
+
+def encode_long(value):
+    """
+    Returns the zigzag varint encoding of an avro long.
+    """
+    value = (value << 1) ^ (value >> 63)
+    encoded = bytearray()
+    while value & ~0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def decode_avro_blocks(header, blocks, schema=None, columns=None):
+    """
+    Decodes raw avro blocks into a dataframe by putting them
+    behind the file header.
+
+    parameters:
+    -----------
+    header: the raw header bytes of the file
+    blocks: the raw block bytes, see read_avro_blocks
+    schema: an avro schema file or dict to decode typed columns with
+    columns: a list of columns to project, requires schema
+
+    return
+    ------
+    a panda dataframe
+    """
+    fo = io.BytesIO(header + blocks)
+    if schema is not None:
+        return ColumnarAvroDecoder(schema, columns).read(fo)
+    return pd.DataFrame(fastavro.reader(fo))
@@ -0,0 +1,166 @@
+import os
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from predicates import apply_filters, filter_columns, stats_rule_out
+from s3api import iterate_table_partitions, open_s3_object_ranges, upload_file_to_s3
+
+
+def select_row_groups(metadata, filters=None):
+    """
+    Returns the row groups whose min/max statistics do not rule
+    out any of the filters.
+
+    parameters:
+    -----------
+    metadata: a pyarrow FileMetaData
+    filters: a list of (column, op, value) tuples
+
+    return
+    ------
+    a list of row group indexes
+    """
+    columns = {metadata.schema.column(i).path: i for i in range(metadata.num_columns)}
+    selected = []
+    for rg in range(metadata.num_row_groups):
+        row_group = metadata.row_group(rg)
+        ruled_out = False
+        for column, op, value in filters or []:
+            if column not in columns:
+                continue
+            statistics = row_group.column(columns[column]).statistics
+            if statistics is None or not statistics.has_min_max:
+                continue
+            if stats_rule_out(statistics.min, statistics.max, op, value):
+                ruled_out = True
+                break
+        if not ruled_out:
+            selected.append(rg)
+    return selected
+
+
+def read_parquet(fo, columns=None, filters=None):
+    """
+    Reads a parquet file object, decoding only the requested
+    columns of the row groups the filters do not rule out.
+
+    parameters:
+    -----------
+    fo: a seekable file object
+    columns: a list of columns, None reads every column
+    filters: a list of (column, op, value) tuples
+
+    return
+    ------
+    a panda dataframe
+    """
+    parquet_file = pq.ParquetFile(fo)
+    row_groups = select_row_groups(parquet_file.metadata, filters)
+    read_columns = columns
+    if columns is not None and filters:
+        read_columns = list(columns) + [
+            c for c in filter_columns(filters) if c not in columns
+        ]
+    if not row_groups:
+        schema = parquet_file.schema_arrow
+        names = read_columns if read_columns is not None else schema.names
+        df = schema.empty_table().select(names).to_pandas()
+    else:
+        df = parquet_file.read_row_groups(row_groups, columns=read_columns).to_pandas()
+    df = apply_filters(df, filters)
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def read_s3_parquet_file(s3_filename, columns=None, filters=None):
+    """
+    Reads from s3 based parquet file and returns a pandas
+    dataframe. Only the footer, and the column chunks of the
+    requested columns in the selected row groups, are fetched,
+    with ranged GETs on the shared s3 client.
+
+    parameters:
+    -----------
+    s3_filename: an s3 filename
+    columns: a list of columns, None reads every column
+    filters: a list of (column, op, value) tuples used to skip
+             row groups by their statistics and to filter rows
+
+    return
+    ------
+    a panda dataframe
+    """
+    with open_s3_object_ranges(s3_filename) as fo:
+        return read_parquet(fo, columns, filters)
+
+
+def write_parquet(dfs, filename, row_group_size=128 * 1024, compression="snappy"):
+    """
+    Writes dataframes into one local parquet file, one or more
+    row groups per dataframe. Every dataframe is cast to the
+    schema of the first one.
+
+    parameters:
+    -----------
+    dfs: an iterator of panda dataframes
+    filename: the local parquet file name
+    row_group_size: the maximum number of rows per row group
+    compression: the parquet compression codec
+
+    return
+    ------
+    the number of rows written
+    """
+    writer = None
+    rows = 0
+    try:
+        for df in dfs:
+            if writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                writer = pq.ParquetWriter(
+                    filename, table.schema, compression=compression
+                )
+            else:
+                table = pa.Table.from_pandas(
+                    df, schema=writer.schema, preserve_index=False
+                )
+            writer.write_table(table, row_group_size=row_group_size)
+            rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def convert_avro_partition_to_parquet(
+    avro_table, parquet_table, rdate, row_group_size=128 * 1024, max_workers=8
+):
+    """
+    Rewrites one avro partition of a table as a single parquet
+    file in the same partition of the parquet table.
+
+    parameters:
+    -----------
+    avro_table: the metastore table holding the avro partition
+    parquet_table: the metastore table to write the parquet file to
+    rdate: the run date of the partition
+    row_group_size: the maximum number of rows per row group
+    max_workers: the number of avro files decoded concurrently
+
+    return
+    ------
+    the parquet file in full s3 path, None for an empty partition
+    """
+    dfs = iterate_table_partitions(avro_table, rdate, max_workers=max_workers)
+    fd, local_file = tempfile.mkstemp(suffix=".parquet")
+    os.close(fd)
+    try:
+        if write_parquet(dfs, local_file, row_group_size) == 0:
+            return None
+        s3_path = "{}/part-00000.parquet".format(parquet_table.path(rdate).rstrip("/"))
+        upload_file_to_s3(local_file, s3_path)
+    finally:
+        os.remove(local_file)
+    return s3_path
@@ -0,0 +1,117 @@
+import operator
+
+import numpy as np
+
+# the operators allowed in a (column, op, value) filter, besides
+# "in" and "not in"
+filter_operators = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def filter_columns(filters=None):
+    """
+    Returns the columns the filters refer to.
+    """
+    return [column for column, _, _ in filters or []]
+
+
+def apply_filters(df, filters=None):
+    """
+    Keeps the rows of the dataframe that match every filter.
+
+    parameters:
+    -----------
+    df: a panda dataframe
+    filters: a list of (column, op, value) tuples, op is one of
+             ==, !=, <, <=, >, >=, in and not in
+
+    return
+    ------
+    a panda dataframe
+    """
+    if not filters:
+        return df
+
+    mask = np.ones(len(df), dtype=bool)
+    for column, op, value in filters:
+        if op == "in":
+            mask &= df[column].isin(value).to_numpy()
+        elif op == "not in":
+            mask &= ~df[column].isin(value).to_numpy()
+        else:
+            matches = filter_operators[op](df[column], value)
+            mask &= matches.fillna(False).to_numpy(dtype=bool)
+    if mask.all():
+        return df
+    return df[mask].reset_index(drop=True)
+
+
+def stats_rule_out(low, high, op, value):
+    """
+    Returns True when no value between the low and high bounds
+    can match the (op, value) predicate.
+    """
+    if low is None or high is None:
+        return False
+    try:
+        if op == "==":
+            return value < low or value > high
+        if op == "<":
+            return low >= value
+        if op == "<=":
+            return low > value
+        if op == ">":
+            return high <= value
+        if op == ">=":
+            return high < value
+        if op == "in":
+            return all(v < low or v > high for v in value)
+    except TypeError:
+        # the bounds and the value are not comparable
+        return False
+    return False
+
+
+def match_values(values, filters=None, coerce=None):
+    """
+    Returns True when the values, e.g. the partition values of a
+    file, match every filter on their columns. Filters on other
+    columns are ignored.
+
+    parameters:
+    -----------
+    values: a dict of column to value
+    filters: a list of (column, op, value) tuples
+    coerce: a function(value, filter value) returning the pair to
+            compare, e.g. with the filter value converted to the
+            type of the column. It raises a ValueError when they
+            can not be compared.
+
+    return
+    ------
+    a boolean
+    """
+    if coerce is None:
+        coerce = _same_values
+    for column, op, value in filters or []:
+        if column not in values:
+            continue
+        if op in ("in", "not in"):
+            found = any(operator.eq(*coerce(values[column], item)) for item in value)
+            matches = found if op == "in" else not found
+        else:
+            matches = filter_operators[op](*coerce(values[column], value))
+        if not matches:
+            return False
+    return True
+
+
+def _same_values(value, filter_value):
+
+    return value, filter_value
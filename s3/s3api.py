@@ -1,13 +1,36 @@
+import functools
+import glob
+import hashlib
+import io
+import logging
+import os
+import queue
+import threading
+import time
 import urllib.parse
 import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-import boto3
 import botocore
 import fastavro
+import numpy as np
 import pandas as pd
+import s3cache
 import s3fs
+from avrocodec import (
+    ColumnarAvroDecoder,
+    decode_avro_blocks,
+    read_avro_blocks,
+    read_avro_header,
+)
+from boto3.s3.transfer import TransferConfig
+from predicates import apply_filters, filter_columns, match_values
+from s3cache import invalidate_listing
 
-from shared.utils import oscmd_rmfile
+from shared.awsclients import get_client, get_resource
+from shared.etlexceptions import ETLException, GPExpTaskException
+from shared.utils import chunked, oscmd_rmfile
 
 
 def get_files_in_s3_folder_by_path(s3_path):
@@ -24,23 +47,7 @@ def get_files_in_s3_folder_by_path(s3_path):
     ------
     return a list of file name
     """
-    use_session = False
-    bucket, prefix = parse_s3_path(s3_path)
-
-    if use_session:
-        session = boto3.Session()
-        client = session.client("s3")
-        response = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        if "Contents" in response.keys():
-            return [f["Key"] for f in response["Contents"]]
-        return []
-
-    # don't use session based otken.
-    client = boto3.client("s3")
-    response = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    if "Contents" in response.keys():
-        return [f["Key"] for f in response["Contents"]]
-    return []
+    return [item["Key"] for item in iterate_s3_objects(s3_path)]
 
 
 def get_files_s3_path_by_path(s3_path):
@@ -57,23 +64,10 @@ def get_files_s3_path_by_path(s3_path):
     ------
     return a list of file name in full s3 path
     """
-    use_session = False
     bucket, prefix = parse_s3_path(s3_path)
-
-    if use_session:
-        session = boto3.Session()
-        client = session.client("s3")
-        response = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        if "Contents" in response.keys():
-            return [f["Key"] for f in response["Contents"]]
-        return []
-
-    # don't use session based otken.
-    client = boto3.client("s3")
-    response = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    if "Contents" in response.keys():
-        return ["s3://{}/{}".format(bucket, f["Key"]) for f in response["Contents"]]
-    return []
+    return [
+        "s3://{}/{}".format(bucket, item["Key"]) for item in iterate_s3_objects(s3_path)
+    ]
 
 
 def iterate_files_s3_path_by_path(s3_path):
@@ -89,65 +83,260 @@ def iterate_files_s3_path_by_path(s3_path):
     ------
     return a generator that contains a list of file name in full s3 path
     """
-    use_session = False
+    return iterate_s3_objects(s3_path)
+
+
+def get_files_in_s3_folder(bucket, prefix):
+    """
+    Returns a list of files in the folder identified
+    by bucket and prefix.
+
+    parameters:
+    ----------
+    bucket: an s3 bucket name
+    prefix: an s3 prefix
+
+    return
+    ------
+    return a list of file name
+    """
+    return [
+        item["Key"] for item in iterate_s3_objects("s3://{}/{}".format(bucket, prefix))
+    ]
+
+
+def list_s3_objects(s3_path, max_workers=16, max_depth=4, pin_cache=False):
+    """
+    Returns every object under the s3 path, see iterate_s3_objects.
+
+    parameters:
+    ----------
+    s3_path: a full s3 path
+
+    return
+    ------
+    a list of object dicts with Key, Size, ETag and LastModified
+    """
+    return list(iterate_s3_objects(s3_path, max_workers, max_depth, pin_cache))
+
+
+def iterate_s3_objects(
+    s3_path, max_workers=16, max_depth=4, pin_cache=False, use_cache=True
+):
+    """
+    Return an iterator over every object under the s3 path.
+    The sub-prefixes (e.g. year=/month=/day=) are discovered
+    level by level with delimiter listings, then the leaf
+    prefixes are listed concurrently and streamed back in
+    prefix order. Every listing is paginated, so there is no
+    1000 keys cap. When the listing cache is enabled (see
+    s3cache.enable_listing_cache) the listing is served from
+    and stored in the cache.
+
+    parameters:
+    ----------
+    s3_path: a full s3 path
+    max_workers: the number of concurrent listings
+    max_depth: the maximum number of prefix levels to discover
+    pin_cache: a flag indicates whether the cached listing never
+               expires, e.g. for a closed partition
+    use_cache: a flag indicates whether the listing cache may be
+               used, False always lists s3, e.g. to find late files
+
+    return
+    ------
+    an iterator of object dicts with Key, Size, ETag and LastModified
+    """
     bucket, prefix = parse_s3_path(s3_path)
+    cache = s3cache.listing_cache if use_cache else None
+    if cache is None:
+        return _iterate_s3_objects(bucket, prefix, max_workers, max_depth)
 
-    if use_session:
-        session = boto3.Session()
-        client = session.client("s3")
-        paginator = client.get_paginator("list_objects_v2")
-        page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix)
+    objects = cache.get(bucket, prefix)
+    if objects is None:
+        objects = list(_iterate_s3_objects(bucket, prefix, max_workers, max_depth))
+        cache.put(bucket, prefix, objects, pinned=pin_cache)
+    return iter(objects)
 
-        for page in page_iterator:
-            if page["KeyCount"] > 0:
-                for item in page["Contents"]:
-                    yield item
 
-    client = boto3.client("s3")
-    paginator = client.get_paginator("list_objects_v2")
-    page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix)
+def _iterate_s3_objects(bucket, prefix, max_workers, max_depth):
+
+    client = get_client("s3")
+    list_level = functools.partial(_list_s3_level, client, bucket)
+    list_leaf = functools.partial(_list_s3_leaf, client, bucket)
 
-    for page in page_iterator:
-        if page["KeyCount"] > 0:
-            for item in page["Contents"]:
+    # expand the prefix tree until there is enough prefixes to keep
+    # every worker busy, yielding the objects found on the way.
+    leaves = [prefix]
+    for depth in range(max_depth):
+        if len(leaves) >= 4 * max_workers:
+            break
+        sub_prefixes = []
+        for level_prefix, level, err in ordered_parallel_map(
+            list_level, leaves, max_workers
+        ):
+            if err is not None:
+                raise err
+            objects, common_prefixes = level
+            for item in objects:
                 yield item
+            sub_prefixes.extend(common_prefixes)
+        if not sub_prefixes:
+            return
+        leaves = sub_prefixes
 
+    for leaf_prefix, objects, err in ordered_parallel_map(
+        list_leaf, leaves, max_workers
+    ):
+        if err is not None:
+            raise err
+        for item in objects:
+            yield item
 
-def get_files_in_s3_folder(bucket, prefix):
+
+def list_s3_prefixes(bucket, prefix, delimiter="/"):
     """
-    Returns a list of files in the folder identified
-    by bucket and prefix.
+    Returns the sub-prefixes right below the prefix.
 
     parameters:
     ----------
     bucket: an s3 bucket name
     prefix: an s3 prefix
+    delimiter: the prefix level delimiter
 
     return
     ------
-    return a list of file name
+    a list of sub-prefixes
+    """
+    return _list_s3_level(get_client("s3"), bucket, prefix, delimiter)[1]
+
+
+def filter_existing_s3_prefixes(s3_paths, max_workers=16):
+    """
+    Returns the s3 paths that have at least one object under them.
+    The paths are grouped by their parent prefix and every parent is
+    listed once with a delimiter, instead of one request per path.
+
+    parameters:
+    ----------
+    s3_paths: a list of full s3 folder paths
+    max_workers: the number of parent prefixes listed concurrently
+
+    return
+    ------
+    the existing s3 paths, in their input order
+    """
+    folders = []
+    parents = set()
+    for s3_path in s3_paths:
+        bucket, prefix = parse_s3_path(s3_path)
+        folder = prefix.rstrip("/") + "/"
+        parent = folder[:-1].rpartition("/")[0]
+        parents.add((bucket, parent + "/" if parent else ""))
+        folders.append((bucket, folder))
+
+    parents = sorted(parents)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = executor.map(lambda parent: list_s3_prefixes(*parent), parents)
+        existing = {
+            (bucket, sub_prefix)
+            for (bucket, _), sub_prefixes in zip(parents, listings)
+            for sub_prefix in sub_prefixes
+        }
+    return [s3_path for s3_path, folder in zip(s3_paths, folders) if folder in existing]
+
+
+def discover_s3_partitions(
+    s3_path, partition_descriptor, separator="=", max_workers=16
+):
+    """
+    Finds the partitions of a hive style partitioned folder, e.g.
+    country=us/day=2020-01-01, by walking the descriptor levels
+    with delimiter listings. The prefixes of each level are listed
+    concurrently, then the files of every partition are counted.
+    Folders that do not match the descriptor are ignored.
+
+    parameters:
+    ----------
+    s3_path: the full s3 path of the table root
+    partition_descriptor: the partition column names, in path order
+    separator: the separator between a column name and its value
+    max_workers: the number of concurrent listings
+
+    return
+    ------
+    a list of dicts with the partition "values" tuple, its "path",
+    and the number of "files" and "bytes" under it, in path order
+    """
+    bucket, prefix = parse_s3_path(s3_path)
+    client = get_client("s3")
+    partitions = [((), prefix.rstrip("/") + "/")]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for column in partition_descriptor:
+            level_prefix = "{}{}".format(column, separator)
+            listings = executor.map(
+                lambda partition: _list_s3_level(client, bucket, partition[1])[1],
+                partitions,
+            )
+            next_partitions = []
+            for (values, _), sub_prefixes in zip(partitions, listings):
+                for sub_prefix in sub_prefixes:
+                    name = sub_prefix[:-1].rsplit("/", 1)[-1]
+                    if name.startswith(level_prefix):
+                        value = name[len(level_prefix) :]
+                        next_partitions.append((values + (value,), sub_prefix))
+            partitions = next_partitions
+
+        leaves = executor.map(
+            lambda partition: _list_s3_leaf(client, bucket, partition[1]), partitions
+        )
+        discovered = []
+        for (values, partition_prefix), objects in zip(partitions, leaves):
+            objects = [
+                item
+                for item in objects
+                if item["Size"] > 0 and not is_hidden_key(item["Key"])
+            ]
+            discovered.append(
+                {
+                    "values": values,
+                    "path": "s3://{}/{}".format(bucket, partition_prefix.rstrip("/")),
+                    "files": len(objects),
+                    "bytes": sum(item["Size"] for item in objects),
+                }
+            )
+    return discovered
+
+
+def _list_s3_level(client, bucket, prefix, delimiter="/"):
     """
-    use_session = False
-    if use_session:
-        session = boto3.Session()
-        client = session.client("s3")
-        response = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        if "Contents" in response.keys():
-            return [f["Key"] for f in response["Contents"]]
-        return []
+    Lists one level of the prefix tree, returns the objects
+    directly under the prefix and the sub-prefixes.
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    objects = []
+    common_prefixes = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter=delimiter):
+        objects.extend(page.get("Contents", []))
+        common_prefixes.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+    return objects, common_prefixes
+
 
-    # don't use session based otken.
-    client = boto3.client("s3")
-    response = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    if "Contents" in response.keys():
-        return [f["Key"] for f in response["Contents"]]
-    return []
+def _list_s3_leaf(client, bucket, prefix):
+    """
+    Lists every object under the prefix.
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    objects = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend(page.get("Contents", []))
+    return objects
 
 
 def check_for_file_s3_path(s3_path):
     """check whether s3 path is valid"""
 
-    client = boto3.client("s3")
+    client = get_client("s3")
     bucket, prefix = parse_s3_path(s3_path)
     try:
         client.head_object(Bucket=bucket, Key=prefix)
@@ -156,23 +345,194 @@ def check_for_file_s3_path(s3_path):
         return False
 
 
-def delete_s3_folder(bucket, prefix):
+def check_for_files_s3_paths(s3_paths, max_workers=32, list_threshold=8):
+    """
+    Checks many s3 paths at once. The HEAD requests run
+    concurrently on a bounded pool, and when list_threshold or
+    more paths share a folder that folder is listed once
+    instead of sending one HEAD per path.
+
+    parameters:
+    -----------
+    s3_paths: a list of full s3 paths
+    max_workers: the number of concurrent requests
+    list_threshold: the number of paths sharing a folder from
+                    which a single LIST is used
+
+    return
+    ------
+    a dict of s3 path to {"exists": bool, "size": int, "etag": str},
+    size and etag are None for the paths that do not exist
+    """
+    folders = defaultdict(list)
+    for s3_path in s3_paths:
+        bucket, key = parse_s3_path(s3_path)
+        folder = key[: key.rfind("/") + 1]
+        folders[(bucket, folder)].append((s3_path, key))
+
+    tasks = []
+    for (bucket, folder), paths in folders.items():
+        if len(paths) >= list_threshold:
+            tasks.append((bucket, folder, paths))
+        else:
+            tasks.extend((bucket, None, [path]) for path in paths)
+
+    results = {}
+    for task, found, err in ordered_parallel_map(_check_s3_keys, tasks, max_workers):
+        if err is not None:
+            raise err
+        results.update(found)
+    return results
+
+
+def _check_s3_keys(task):
+    """
+    Checks the keys of one task, a (bucket, folder, paths) tuple.
+    A task with a folder is answered from a single listing of it,
+    otherwise its only key gets a HEAD request.
+    """
+    bucket, folder, paths = task
+    client = get_client("s3")
+    if folder is None:
+        s3_path, key = paths[0]
+        try:
+            response = client.head_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError:
+            return {s3_path: {"exists": False, "size": None, "etag": None}}
+        return {
+            s3_path: {
+                "exists": True,
+                "size": response["ContentLength"],
+                "etag": response["ETag"],
+            }
+        }
+
+    objects = {item["Key"]: item for item in _list_s3_level(client, bucket, folder)[0]}
+    found = {}
+    for s3_path, key in paths:
+        item = objects.get(key)
+        if item is None:
+            found[s3_path] = {"exists": False, "size": None, "etag": None}
+        else:
+            found[s3_path] = {
+                "exists": True,
+                "size": item["Size"],
+                "etag": item["ETag"],
+            }
+    return found
+
+
+def delete_s3_folder(bucket, prefix, dry_run=False, max_workers=16, progress=None):
     """
-    Deleted set of folder in a bucket
+    Deleted set of folder in a bucket. The folder is listed with
+    the parallel listing and the keys are sent in concurrent
+    DeleteObjects batches of 1000 keys.
 
     parameters:
     -----------
     bucket: an s3 bucket name
     prefix: an s3 prefix
+    dry_run: a flag indicates whether to only count what would be deleted
+    max_workers: the number of concurrent listings and delete batches
+    progress: an optional function(objects, bytes) called after each batch
+
+    return
+    ------
+    a dict with the number of objects, the bytes, and the per key
+    errors of the keys that could not be deleted
+    """
+    # never serve a deletion from the listing cache
+    objects = _iterate_s3_objects(bucket, prefix, max_workers, 4)
+    stats = {"objects": 0, "bytes": 0, "errors": {}, "dry_run": dry_run}
+
+    if dry_run:
+        for item in objects:
+            stats["objects"] += 1
+            stats["bytes"] += item["Size"]
+        return stats
+
+    delete_batch = functools.partial(delete_s3_batch, bucket)
+    for batch, errors, err in ordered_parallel_map(
+        delete_batch, chunked(objects, 1000), max_workers
+    ):
+        if err is not None:
+            errors = {item["Key"]: repr(err) for item in batch}
+        stats["errors"].update(errors)
+        for item in batch:
+            if item["Key"] not in errors:
+                stats["objects"] += 1
+                stats["bytes"] += item["Size"]
+        if progress is not None:
+            progress(stats["objects"], stats["bytes"])
+    invalidate_listing(bucket, prefix)
+
+    logging.info(
+        "Deleted {} objects, {} bytes under s3://{}/{} with {} errors".format(
+            stats["objects"], stats["bytes"], bucket, prefix, len(stats["errors"])
+        )
+    )
+    return stats
+
+
+def delete_table_partitions(table, start, end=None, dry_run=False, max_workers=16):
     """
+    Deletes every partition of a metastore table in the start/end
+    window, see delete_s3_folder.
+
+    parameters:
+    -----------
+    table: a metastore Table or KinesisTable
+    start: the first run date of the window
+    end: the last run date of the window, defaults to start
+    dry_run: a flag indicates whether to only count what would be deleted
+    max_workers: the number of concurrent listings and delete batches
 
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket(bucket)
-    bucket.objects.filter(Prefix=prefix).delete()
     return
+    ------
+    a dict with the number of objects, the bytes and the per key errors
+    """
+    stats = {"objects": 0, "bytes": 0, "errors": {}, "dry_run": dry_run}
+    for rdate in table.partition_dates(start, end):
+        bucket, prefix = parse_s3_path(table.path(rdate))
+        partition_stats = delete_s3_folder(
+            bucket, prefix.rstrip("/") + "/", dry_run, max_workers
+        )
+        stats["objects"] += partition_stats["objects"]
+        stats["bytes"] += partition_stats["bytes"]
+        stats["errors"].update(partition_stats["errors"])
+    return stats
 
 
-def read_s3_avro_file(s3_filename, userid="test", use_s3fs=False):
+def delete_s3_batch(bucket, batch):
+    """
+    Deletes up to 1000 objects with one request.
+
+    parameters:
+    ----------
+    bucket: an s3 bucket name
+    batch: a list of up to 1000 object dicts with a Key
+
+    return
+    ------
+    a dict of key to error message of the keys that were not deleted
+    """
+    response = get_client("s3").delete_objects(
+        Bucket=bucket,
+        Delete={"Objects": [{"Key": item["Key"]} for item in batch], "Quiet": True},
+    )
+    return {
+        e["Key"]: e.get("Message", e.get("Code")) for e in response.get("Errors", [])
+    }
+
+
+def read_s3_avro_file(
+    s3_filename,
+    userid="test",
+    use_s3fs=False,
+    streaming=False,
+    schema=None,
+    columns=None,
+):
     """
     Reads from s3 based avro file and returns
     a pandas dataframe.
@@ -181,13 +541,37 @@ def read_s3_avro_file(s3_filename, userid="test", use_s3fs=False):
     -----------
     s3_filename: an s3 filename
     userid: a prefix of filename for downloading avro file to local
-    use_s3fs: a flag indicates whether to use s3fs module or not
+    use_s3fs: a flag indicates whether to use s3fs module or not,
+              the object cache (see s3cache.enable_object_cache)
+              is used unless it is set
+    streaming: a flag indicates whether to decode straight from the
+               s3 body stream without a local copy
+    schema: an avro schema file or dict, when given the records are
+            decoded into typed columns instead of going through
+            pandas type inference
+    columns: a list of columns to project, requires schema
 
     return
     ------
     a panda dataframe
     """
 
+    cache = s3cache.object_cache
+    if cache is not None and not use_s3fs:
+        bucket, path = parse_s3_path(s3_filename)
+        with cache.open(bucket, path) as fo:
+            if schema is not None:
+                return ColumnarAvroDecoder(schema, columns).read(fo)
+            return pd.DataFrame(fastavro.reader(fo))
+
+    if schema is not None:
+        decoder = ColumnarAvroDecoder(schema, columns)
+        body = open_s3_object_stream(s3_filename)
+        try:
+            return decoder.read(body)
+        finally:
+            body.close()
+
     if use_s3fs:
         if s3_filename.startswith("s3://"):
             s3_filename = s3_filename.split("s3://")[1]
@@ -199,23 +583,801 @@ def read_s3_avro_file(s3_filename, userid="test", use_s3fs=False):
             df = pd.DataFrame(records)
         return df
 
+    if streaming:
+        body = open_s3_object_stream(s3_filename)
+        try:
+            return pd.DataFrame(fastavro.reader(body))
+        finally:
+            body.close()
+
     # use raw api from boto3 and others.
     bucket, path = parse_s3_path(s3_filename)
-    bucket_api = boto3.resource("s3").Bucket(bucket)
+    bucket_api = get_resource("s3").Bucket(bucket)
     original_filename = path.split("/")[-1].split(".avro")[0]
     tmp_avro_filename = "{}_{}_{}.avro".format(
         userid, original_filename, str(uuid.uuid4())
     )
-    with open(tmp_avro_filename, "wb") as fout:
-        bucket_api.download_fileobj(path, fout)
+    try:
+        with open(tmp_avro_filename, "wb") as fout:
+            bucket_api.download_fileobj(path, fout)
+
+        with open(tmp_avro_filename, "rb") as fin:
+            records = [record for record in fastavro.reader(fin)]
+            df = pd.DataFrame(records)
+    finally:
+        if os.path.exists(tmp_avro_filename):
+            oscmd_rmfile(tmp_avro_filename)
+    return df
+
+
+def iterate_s3_avro_file(s3_filename, chunk_size=100000, schema=None, columns=None):
+    """
+    Return a generator that decodes an s3 based avro file
+    straight from the s3 body stream and yields pandas
+    dataframes of at most chunk_size records, so memory
+    stays bounded by the chunk size and not the object size.
+
+    parameters:
+    -----------
+    s3_filename: an s3 filename
+    chunk_size: the maximum number of records per dataframe
+    schema: an avro schema file or dict to decode typed columns with
+    columns: a list of columns to project, requires schema
+
+    return
+    ------
+    a generator of panda dataframes
+    """
+    body = open_s3_object_stream(s3_filename)
+    try:
+        if schema is not None:
+            decoder = ColumnarAvroDecoder(schema, columns, chunk_size)
+            for df in decoder.decode(body):
+                yield df
+        else:
+            for records in chunked(fastavro.reader(body), chunk_size):
+                yield pd.DataFrame(records)
+    finally:
+        body.close()
+
+
+def read_s3_avro_file_parallel(
+    s3_filename,
+    range_size=64 * 1024 * 1024,
+    max_workers=8,
+    use_processes=False,
+    schema=None,
+    columns=None,
+):
+    """
+    Reads one large s3 based avro file with several workers.
+    The object is split into byte ranges, each worker fetches
+    its range with ranged GETs, finds the first block boundary
+    from the sync marker and decodes the blocks that start in
+    its range. The chunks are put back together in file order.
+
+    parameters:
+    -----------
+    s3_filename: an s3 filename
+    range_size: the number of bytes decoded by one worker task
+    max_workers: the size of the thread or process pool
+    use_processes: a flag indicates whether to decode in a process pool
+    schema: an avro schema file or dict to decode typed columns with
+    columns: a list of columns to project, requires schema
+
+    return
+    ------
+    a panda dataframe
+    """
+    dfs = list(
+        iterate_s3_avro_file_ranges(
+            s3_filename, range_size, max_workers, use_processes, schema, columns
+        )
+    )
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True)
+
+
+def iterate_s3_avro_file_ranges(
+    s3_filename,
+    range_size=64 * 1024 * 1024,
+    max_workers=8,
+    use_processes=False,
+    schema=None,
+    columns=None,
+):
+    """
+    Return a generator of the dataframes decoded from the byte
+    ranges of one s3 based avro file, in file order. See
+    read_s3_avro_file_parallel for the parameters.
+    """
+    bucket, path = parse_s3_path(s3_filename)
+    size = get_client("s3").head_object(Bucket=bucket, Key=path)["ContentLength"]
+    read_range = functools.partial(_read_s3_range, bucket, path, size)
+    header, sync_marker = read_avro_header(read_range)
+    tasks = [
+        (bucket, path, size, header, sync_marker, start, start + range_size)
+        for start in range(len(header), size, range_size)
+    ]
+    decode_range = functools.partial(
+        _decode_s3_avro_range, schema=schema, columns=columns
+    )
+    for task, df, err in ordered_parallel_map(
+        decode_range, tasks, max_workers, use_processes
+    ):
+        if err is not None:
+            raise err
+        if len(df):
+            yield df
+
+
+def _read_s3_range(bucket, path, size, offset, length):
+
+    if offset >= size:
+        return b""
+    end = min(offset + length, size) - 1
+    response = get_client("s3").get_object(
+        Bucket=bucket, Key=path, Range="bytes={}-{}".format(offset, end)
+    )
+    return response["Body"].read()
+
+
+def _decode_s3_avro_range(task, schema=None, columns=None):
+
+    bucket, path, size, header, sync_marker, start, stop = task
+    read_range = functools.partial(_read_s3_range, bucket, path, size)
+    blocks = read_avro_blocks(read_range, sync_marker, start, stop)
+    return decode_avro_blocks(header, blocks, schema, columns)
+
+
+class _S3RangeFile(io.RawIOBase):
+    """
+    A read only, seekable file over an s3 object, every read is a
+    ranged GET on the shared client.
+    """
+
+    def __init__(self, bucket, path, size):
+
+        self._bucket = bucket
+        self._path = path
+        self._size = size
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+
+        if whence == io.SEEK_CUR:
+            offset += self._offset
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._offset = max(offset, 0)
+        return self._offset
+
+    def readinto(self, buffer):
+
+        data = _read_s3_range(
+            self._bucket, self._path, self._size, self._offset, len(buffer)
+        )
+        buffer[: len(data)] = data
+        self._offset += len(data)
+        return len(data)
+
+
+def open_s3_object_ranges(s3_path, buffer_size=64 * 1024):
+    """
+    Opens the s3 object as a seekable file that only fetches the
+    byte ranges that are read, e.g. the footer and some column
+    chunks of a parquet file.
+
+    parameters
+    ----------
+    s3_path: a full s3 path
+    buffer_size: the fewest bytes fetched by one GET
+
+    return
+    ------
+    a buffered binary file object, the caller is responsible for closing it
+    """
+    bucket, path = parse_s3_path(s3_path)
+    size = get_client("s3").head_object(Bucket=bucket, Key=path)["ContentLength"]
+    return io.BufferedReader(_S3RangeFile(bucket, path, size), buffer_size)
+
+
+def open_s3_object_stream(s3_path):
+    """
+    Opens the s3 object for streaming read.
+
+    parameters
+    ----------
+    s3_path: a full s3 path
+
+    return
+    ------
+    a file like streaming body, the caller is responsible for closing it
+    """
+    client = get_client("s3")
+    bucket, path = parse_s3_path(s3_path)
+    return client.get_object(Bucket=bucket, Key=path)["Body"]
+
+
+def get_table_partition_files(table, start, end=None, filters=None, use_manifest=False):
+    """
+    Returns the data files of every partition of a metastore
+    table in the start/end window, in partition order. The
+    partitions whose values do not match the filters on the
+    partition columns are skipped without being listed.
+
+    parameters:
+    -----------
+    table: a metastore Table, KinesisTable or S3TableWithPartition,
+           the partitions of the latter come from its discovery and
+           the start/end window does not apply to them
+    start: the first run date of the window
+    end: the last run date of the window, defaults to start
+    filters: a list of (column, op, value) tuples, with use_manifest
+             the files whose stats rule them out are left out
+    use_manifest: a flag indicates whether to plan the partitions
+                  from their manifest, see s3manifest. Partitions
+                  without a manifest are listed.
+
+    return
+    ------
+    a list of file names in full s3 path
+    """
+    if use_manifest:
+        from s3manifest import plan_partition_files
+
+    files = []
+    for rdate, partition_path in plan_table_partitions(table, start, end, filters):
+        if use_manifest and rdate is not None:
+            planned = plan_partition_files(table, rdate, filters)
+            if planned is not None:
+                files.extend(planned)
+                continue
+
+        bucket, prefix = parse_s3_path(partition_path)
+        for item in iterate_s3_objects(
+            "s3://{}/{}/".format(bucket, prefix.rstrip("/")),
+            pin_cache=table.is_partition_closed(rdate),
+        ):
+            # skip folder markers, empty objects and manifests
+            if item["Size"] > 0 and not is_hidden_key(item["Key"]):
+                files.append("s3://{}/{}".format(bucket, item["Key"]))
+    return files
+
+
+def plan_table_partitions(table, start, end=None, filters=None):
+    """
+    Returns the partitions of a table whose partition values match
+    the filters. The partitions of an S3TableWithPartition come from
+    its get_partitions, i.e. from the catalog of its database when
+    one is attached.
+
+    parameters:
+    ----------
+    table: a metastore Table, KinesisTable or S3TableWithPartition
+    start: the first run date, ignored for an S3TableWithPartition
+    end: the last run date, defaults to start
+    filters: a list of (column, op, value) tuples, only the filters
+             on partition columns are applied
+
+    return
+    ------
+    a list of (run date, partition path) tuples, the run date is
+    None for an S3TableWithPartition
+    """
+    if getattr(table, "partition_descriptor", None) is not None:
+        return [
+            (None, partition["path"])
+            for partition in table.get_partitions()
+            if match_values(
+                dict(zip(table.partition_columns, partition["values"])),
+                filters,
+                table.coerce_partition_filter,
+            )
+        ]
+    return [
+        (rdate, table.path(rdate))
+        for rdate in table.partition_dates(start, end)
+        if match_values(
+            table.partition_values(rdate), filters, table.coerce_partition_filter
+        )
+    ]
+
+
+def _split_partition_columns(
+    table, columns=None, filters=None, partition_columns=False
+):
+    """
+    Splits the columns and the filters of a table read between
+    the partition columns, which only live in the file paths, and
+    the data columns of the files.
+
+    return
+    ------
+    the data columns, the data filters and the partition columns
+    to attach to every dataframe
+    """
+    names = table.partition_columns
+    data_filters = [f for f in filters or [] if f[0] not in names] or None
+    if not partition_columns:
+        return columns, data_filters, []
+    if columns is None:
+        return None, data_filters, list(names)
+    return (
+        [c for c in columns if c not in names],
+        data_filters,
+        [c for c in columns if c in names],
+    )
+
+
+def attach_partition_columns(df, partition_values, columns=None):
+    """
+    Adds partition values to a dataframe as constant categorical
+    columns. The columns are inserted in place, so only the one
+    byte codes of the new columns are allocated; pass a frame the
+    caller owns, e.g. the one a reader just returned.
+
+    parameters:
+    -----------
+    df: a panda dataframe
+    partition_values: a dict of partition column to value, see
+                      Table.parse_partition_values
+    columns: the partition columns to add, None adds every one
+
+    return
+    ------
+    the same panda dataframe
+    """
+    codes = np.zeros(len(df), dtype=np.int8)
+    for column, value in partition_values.items():
+        if columns is None or column in columns:
+            df[column] = pd.Categorical.from_codes(codes, categories=[value])
+    return df
+
+
+def _order_columns(df, columns):
+    # selecting the columns copies the frame, skip it when in order
+    if columns is None or list(df.columns) == list(columns):
+        return df
+    return df[list(columns)]
+
+
+def is_hidden_key(key):
+    """
+    Returns True for the metadata objects of a partition, such as
+    _manifest.json or _SUCCESS, which are not data files.
+
+    parameters:
+    ----------
+    key: an s3 object key
+
+    return
+    ------
+    a boolean
+    """
+    name = key.rsplit("/", 1)[-1]
+    return name.startswith("_") or name.startswith(".")
+
+
+def iterate_table_partitions(
+    table,
+    start,
+    end=None,
+    max_workers=8,
+    use_processes=False,
+    on_error="raise",
+    columns=None,
+    filters=None,
+    use_manifest=False,
+    partition_columns=False,
+):
+    """
+    Return a generator that fetches and decodes the files of
+    a table's partitions concurrently and yields one dataframe per
+    file, in partition and file order. Tables stored as parquet
+    only fetch the requested columns and skip the row groups
+    ruled out by the filters.
+
+    parameters:
+    -----------
+    table: a metastore Table or KinesisTable
+    start: the first run date of the window
+    end: the last run date of the window, defaults to start
+    max_workers: the size of the thread or process pool
+    use_processes: a flag indicates whether to decode in a process pool
+    on_error: "raise" to fail once every file has been tried,
+              "skip" to log the failed files and carry on
+    columns: a list of columns to project, when the table has a
+             schema the files are decoded into typed columns
+    filters: a list of (column, op, value) tuples the rows must match
+    use_manifest: a flag indicates whether to plan the files from the
+                  partition manifests, skipping the files whose stats
+                  rule out the filters
+    partition_columns: a flag indicates whether to add the partition
+                       columns of the file paths as categoricals.
+                       Filters on partition columns always prune
+                       the partitions before any listing.
+
+    return
+    ------
+    a generator of panda dataframes
+    """
+    files = get_table_partition_files(table, start, end, filters, use_manifest)
+    data_columns, data_filters, attach_columns = _split_partition_columns(
+        table, columns, filters, partition_columns
+    )
+    if table.storage_format == "parquet":
+        # pyarrow is only needed by the tables stored as parquet
+        from parquetio import read_s3_parquet_file
+
+        read_func = functools.partial(
+            read_s3_parquet_file, columns=data_columns, filters=data_filters
+        )
+    else:
+        # the schema file is loaded once per process by the schema registry
+        read_func = functools.partial(
+            _read_s3_avro_file_filtered,
+            schema=table.schema,
+            columns=data_columns,
+            filters=data_filters,
+        )
+    errors = {}
+    for s3_filename, df, err in ordered_parallel_map(
+        read_func, files, max_workers, use_processes
+    ):
+        if err is not None:
+            logging.error("Failed to read {}: {!r}".format(s3_filename, err))
+            errors[s3_filename] = err
+            continue
+        if attach_columns:
+            df = attach_partition_columns(
+                df, table.parse_partition_values(s3_filename), attach_columns
+            )
+            df = _order_columns(df, columns)
+        yield df
+
+    if errors and on_error == "raise":
+        raise GPExpTaskException(
+            "Failed to read {} of {} files of {}".format(
+                len(errors), len(files), table.name
+            ),
+            errors=errors,
+        )
+
+
+def read_table_partitions(
+    table,
+    start,
+    end=None,
+    max_workers=8,
+    use_processes=False,
+    on_error="raise",
+    columns=None,
+    filters=None,
+    use_manifest=False,
+    partition_columns=False,
+):
+    """
+    Reads the files of a table's partitions concurrently
+    and returns them as one pandas dataframe.
+
+    parameters:
+    -----------
+    see iterate_table_partitions
+
+    return
+    ------
+    a panda dataframe
+    """
+    dfs = list(
+        iterate_table_partitions(
+            table,
+            start,
+            end,
+            max_workers,
+            use_processes,
+            on_error,
+            columns,
+            filters,
+            use_manifest,
+            partition_columns,
+        )
+    )
+    if not dfs:
+        return pd.DataFrame()
+    return _concat_frames(dfs)
+
 
-    with open(tmp_avro_filename, "rb") as fin:
-        records = [record for record in fastavro.reader(fin)]
-        df = pd.DataFrame(records)
-    oscmd_rmfile(tmp_avro_filename)
+def _concat_frames(dfs):
+    """
+    Concatenates dataframes, keeping the categorical columns, such
+    as the partition columns, categorical when the categories of
+    the dataframes differ.
+    """
+    df = pd.concat(dfs, ignore_index=True)
+    for column, dtype in dfs[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype) and not isinstance(
+            df[column].dtype, pd.CategoricalDtype
+        ):
+            df[column] = df[column].astype("category")
     return df
 
 
+def scan_table(
+    table,
+    start,
+    end=None,
+    columns=None,
+    filter=None,
+    chunk_rows=100000,
+    max_workers=4,
+    use_manifest=False,
+    partition_columns=False,
+    prefetch_chunks=2,
+):
+    """
+    Return a lazy generator over the rows of a table's partitions
+    as dataframes of chunk_rows rows (the last one may be smaller).
+    Nothing is listed or fetched until the first chunk is asked
+    for. The files are then planned and decoded chunk by chunk:
+    max_workers files at a time, each at most prefetch_chunks
+    chunks ahead of the consumer. Memory stays bounded by about
+    max_workers * (prefetch_chunks + 1) chunks, however long the
+    window and however large the files are; parquet files are
+    still read whole before they are chunked.
+
+    parameters:
+    -----------
+    table: a metastore Table or KinesisTable
+    start: the first run date of the window
+    end: the last run date of the window, defaults to start
+    columns: a list of columns to project
+    filter: a list of (column, op, value) tuples, pushed down to the
+            manifests and parquet row groups, or a function taking a
+            chunk of the projected columns and returning a boolean mask
+    chunk_rows: the number of rows of each dataframe
+    max_workers: the number of files decoded concurrently, 1 streams
+                 a single file at a time straight from its s3 body
+    use_manifest: a flag indicates whether to plan the files from the
+                  partition manifests, see get_table_partition_files
+    partition_columns: a flag indicates whether to add the partition
+                       columns as categoricals, see iterate_table_partitions
+    prefetch_chunks: the decoded chunks buffered per file
+
+    return
+    ------
+    a generator of panda dataframes
+    """
+    row_filter = filter if callable(filter) else None
+    filters = None if row_filter is not None else filter
+    files = get_table_partition_files(table, start, end, filters, use_manifest)
+    data_columns, data_filters, attach_columns = _split_partition_columns(
+        table, columns, filters, partition_columns
+    )
+    scan_file = functools.partial(
+        _scan_s3_file,
+        storage_format=table.storage_format,
+        schema=table.schema,
+        columns=data_columns,
+        filters=data_filters,
+        row_filter=row_filter,
+        chunk_rows=chunk_rows,
+    )
+    if attach_columns:
+        scan_file = functools.partial(
+            _scan_s3_file_with_partition,
+            scan_file,
+            table.parse_partition_values,
+            attach_columns,
+            columns,
+        )
+    if max_workers == 1:
+        dfs = (df for s3_filename in files for df in scan_file(s3_filename))
+    else:
+        dfs = _scan_s3_files(scan_file, files, max_workers, prefetch_chunks)
+    for df in _rebatch(dfs, chunk_rows):
+        yield df
+
+
+def _scan_s3_file_with_partition(
+    scan_file, parse_partition_values, attach_columns, columns, s3_filename
+):
+
+    partition_values = parse_partition_values(s3_filename)
+    for df in scan_file(s3_filename):
+        df = attach_partition_columns(df, partition_values, attach_columns)
+        df = _order_columns(df, columns)
+        yield df
+
+
+def _scan_s3_files(scan_file, files, max_workers, prefetch_chunks):
+    """
+    Yields the chunks of the files in file order. Up to max_workers
+    files are decoded at a time, each into its own queue of at most
+    prefetch_chunks chunks; the next file is only started once the
+    consumer is done with one.
+    """
+    files = iter(files)
+    cancelled = threading.Event()
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit():
+        for s3_filename in files:
+            chunks = queue.Queue(maxsize=prefetch_chunks)
+            executor.submit(_produce_chunks, scan_file, s3_filename, chunks, cancelled)
+            pending.append((s3_filename, chunks))
+            return
+
+    try:
+        for _ in range(max_workers):
+            submit()
+        while pending:
+            s3_filename, chunks = pending.popleft()
+            while True:
+                df, err = chunks.get()
+                if err is not None:
+                    raise GPExpTaskException(
+                        "Failed to scan {}".format(s3_filename),
+                        errors={s3_filename: err},
+                    )
+                if df is None:
+                    break
+                yield df
+            submit()
+    finally:
+        # unblocks the workers of a scan closed before its end
+        cancelled.set()
+        executor.shutdown(wait=True)
+
+
+def _produce_chunks(scan_file, s3_filename, chunks, cancelled):
+    """
+    Decodes one file into the chunks queue, ended by (None, None)
+    or by (None, error).
+    """
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    dfs = scan_file(s3_filename)
+    try:
+        for df in dfs:
+            if not put((df, None)):
+                return
+    except Exception as err:
+        put((None, err))
+        return
+    finally:
+        dfs.close()
+    put((None, None))
+
+
+def _scan_s3_file(
+    s3_filename, storage_format, schema, columns, filters, row_filter, chunk_rows
+):
+    """
+    Yields the filtered and projected chunks of one table file.
+    """
+    read_columns = columns
+    if columns is not None and filters:
+        read_columns = list(columns) + [
+            c for c in filter_columns(filters) if c not in columns
+        ]
+    if storage_format == "parquet":
+        from parquetio import read_s3_parquet_file
+
+        df = read_s3_parquet_file(s3_filename, read_columns, filters)
+        dfs = (df.iloc[i : i + chunk_rows] for i in range(0, len(df), chunk_rows))
+    elif schema is not None:
+        dfs = iterate_s3_avro_file(s3_filename, chunk_rows, schema, read_columns)
+    else:
+        dfs = iterate_s3_avro_file(s3_filename, chunk_rows)
+
+    for df in dfs:
+        df = apply_filters(df, filters)
+        if columns is not None:
+            df = df[list(columns)]
+        if row_filter is not None:
+            df = df[np.asarray(row_filter(df), dtype=bool)]
+        if len(df) > 0:
+            yield df
+
+
+def _rebatch(dfs, chunk_rows):
+    """
+    Regroups a stream of dataframes into chunks of chunk_rows rows.
+    """
+    pending = []
+    pending_rows = 0
+    for df in dfs:
+        pending.append(df)
+        pending_rows += len(df)
+        if pending_rows < chunk_rows:
+            continue
+        merged = _concat_frames(pending)
+        split = (len(merged) // chunk_rows) * chunk_rows
+        for i in range(0, split, chunk_rows):
+            yield merged.iloc[i : i + chunk_rows].reset_index(drop=True)
+        pending = [merged.iloc[split:]]
+        pending_rows = len(merged) - split
+    if pending_rows > 0:
+        yield _concat_frames(pending)
+
+
+def _read_s3_avro_file_filtered(s3_filename, schema=None, columns=None, filters=None):
+
+    if schema is None:
+        df = read_s3_avro_file(s3_filename, streaming=True)
+    else:
+        read_columns = columns
+        if columns is not None:
+            read_columns = list(columns) + [
+                c for c in filter_columns(filters) if c not in columns
+            ]
+        df = read_s3_avro_file(s3_filename, schema=schema, columns=read_columns)
+    df = apply_filters(df, filters)
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def ordered_parallel_map(func, items, max_workers=8, use_processes=False):
+    """
+    Runs func over items on a bounded pool, in the order of items.
+    At most 2 * max_workers calls are in flight, so results that
+    are not consumed yet do not pile up in memory.
+
+    parameters:
+    ----------
+    func: a function of one item, picklable with use_processes
+    items: an iterable of items
+    max_workers: the size of the pool
+    use_processes: a flag indicates whether to run func in processes
+                   instead of threads
+
+    return
+    ------
+    an iterator of (item, result, error) tuples, error is the
+    exception func raised or None
+    """
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    items = iter(items)
+    with executor_class(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= 2 * max_workers:
+                break
+
+        while pending:
+            item, future = pending.popleft()
+            try:
+                result, error = future.result(), None
+            except Exception as err:
+                result, error = None, err
+            yield item, result, error
+            for item in items:
+                pending.append((item, executor.submit(func, item)))
+                break
+
+
 def parse_s3_path(s3_path):
     """
     A helper function to parse a complete s3 path.
@@ -233,7 +1395,9 @@ def parse_s3_path(s3_path):
     return s3_detail.netloc, s3_detail.path[1:]
 
 
-def upload_file_to_s3(filename, s3_path):
+def upload_file_to_s3(
+    filename, s3_path, multipart_chunksize=None, max_concurrency=None, verify=None
+):
     """
     uploads the given file to s3.
 
@@ -241,17 +1405,174 @@ def upload_file_to_s3(filename, s3_path):
     ----------
     filename: the local file name to be uploaded
     s3_path: destination s3 path
+    multipart_chunksize: the multipart part size in bytes, files
+                         larger than a part are uploaded in parts
+    max_concurrency: the number of parts uploaded concurrently
+    verify: None, "size" to compare the object size or "md5" to
+            compare the object etag with the local content md5.
+            "md5" does not apply to SSE-KMS encrypted buckets.
 
     return
     ------
     upload status
     """
-    s3_client = boto3.client("s3")
+    s3_client = get_client("s3")
     bucket, path = parse_s3_path(s3_path)
-    retcode = s3_client.upload_file(filename, bucket, path)
+    transfer_args = {}
+    if multipart_chunksize is not None:
+        transfer_args["multipart_chunksize"] = multipart_chunksize
+        transfer_args["multipart_threshold"] = multipart_chunksize
+    if max_concurrency is not None:
+        transfer_args["max_concurrency"] = max_concurrency
+    config = TransferConfig(**transfer_args)
+    retcode = s3_client.upload_file(filename, bucket, path, Config=config)
+    invalidate_listing(bucket, path)
+
+    if verify is not None:
+        response = s3_client.head_object(Bucket=bucket, Key=path)
+        if verify == "size":
+            expected, actual = os.path.getsize(filename), response["ContentLength"]
+        elif verify == "md5":
+            expected = _expected_etag(
+                filename, config.multipart_threshold, config.multipart_chunksize
+            )
+            actual = response["ETag"].strip('"')
+        else:
+            raise ValueError("Unknown verify mode {}".format(verify))
+        if expected != actual:
+            raise ETLException(
+                "Upload of {} to {} failed {} check: expected {}, got {}".format(
+                    filename, s3_path, verify, expected, actual
+                )
+            )
     return retcode
 
 
+def upload_directory_to_s3(
+    local_path,
+    destination,
+    rdate=None,
+    partition_vals=None,
+    pattern="**/*",
+    max_workers=16,
+    multipart_chunksize=64 * 1024 * 1024,
+    max_concurrency=4,
+    verify=None,
+):
+    """
+    uploads every file of a local directory, or every file matching
+    a glob, concurrently to a table partition or an s3 path. Files
+    keep their path relative to local_path (their base name for a
+    glob) below the destination.
+
+    parameters
+    ----------
+    local_path: a local directory or a glob such as "out/*.avro"
+    destination: a full s3 path, a metastore Table whose partition
+                 is given by rdate, or an S3TableWithPartition whose
+                 partition is given by partition_vals
+    rdate: the run date of the Table partition
+    partition_vals: the partition values of the S3TableWithPartition
+    pattern: the glob used to pick files under a local directory
+    max_workers: the number of files uploaded concurrently
+    multipart_chunksize: the multipart part size in bytes
+    max_concurrency: the number of parts uploaded concurrently per file
+    verify: None, "size" or "md5", see upload_file_to_s3
+
+    return
+    ------
+    a dict with the per file results, the number of failed files,
+    the total bytes, seconds and MB/s
+    """
+    if isinstance(destination, str):
+        s3_root = destination
+    elif partition_vals is not None:
+        s3_root = destination.path_by_vals(partition_vals)
+    else:
+        s3_root = destination.path(rdate)
+    s3_root = s3_root.rstrip("/")
+
+    if os.path.isdir(local_path):
+        filenames = glob.glob(os.path.join(local_path, pattern), recursive=True)
+        relative_names = [os.path.relpath(f, local_path) for f in filenames]
+    else:
+        filenames = glob.glob(local_path, recursive=True)
+        relative_names = [os.path.basename(f) for f in filenames]
+    uploads = [
+        (f, "{}/{}".format(s3_root, name.replace(os.sep, "/")))
+        for f, name in sorted(zip(filenames, relative_names))
+        if os.path.isfile(f)
+    ]
+
+    upload = functools.partial(
+        _upload_file_task,
+        multipart_chunksize=multipart_chunksize,
+        max_concurrency=max_concurrency,
+        verify=verify,
+    )
+    start_time = time.perf_counter()
+    results = []
+    for (filename, s3_path), size, err in ordered_parallel_map(
+        upload, uploads, max_workers
+    ):
+        if err is not None:
+            logging.error("Failed to upload {}: {!r}".format(filename, err))
+        results.append(
+            {
+                "filename": filename,
+                "s3_path": s3_path,
+                "size": size,
+                "error": err,
+            }
+        )
+    run_time = time.perf_counter() - start_time
+
+    total_bytes = sum(r["size"] for r in results if r["error"] is None)
+    summary = {
+        "results": results,
+        "failed": sum(1 for r in results if r["error"] is not None),
+        "bytes": total_bytes,
+        "seconds": run_time,
+        "mb_per_sec": total_bytes / (1024 * 1024) / run_time if run_time else 0.0,
+    }
+    logging.info(
+        "Uploaded {} files, {} bytes to {} in {:.2f} secs ({:.2f} MB/s)".format(
+            len(results) - summary["failed"],
+            total_bytes,
+            s3_root,
+            run_time,
+            summary["mb_per_sec"],
+        )
+    )
+    return summary
+
+
+def _upload_file_task(upload, multipart_chunksize, max_concurrency, verify):
+
+    filename, s3_path = upload
+    upload_file_to_s3(filename, s3_path, multipart_chunksize, max_concurrency, verify)
+    return os.path.getsize(filename)
+
+
+def _expected_etag(filename, multipart_threshold, multipart_chunksize):
+    """
+    Returns the etag s3 computes for the file: the content md5
+    for a single part upload, otherwise the md5 of the part md5s
+    followed by the number of parts.
+    """
+    if os.path.getsize(filename) < multipart_threshold:
+        with open(filename, "rb") as fin:
+            return hashlib.md5(fin.read()).hexdigest()
+
+    part_digests = []
+    with open(filename, "rb") as fin:
+        for part in iter(lambda: fin.read(multipart_chunksize), b""):
+            part_digests.append(hashlib.md5(part).digest())
+    return "{}-{}".format(
+        hashlib.md5(b"".join(part_digests)).hexdigest(), len(part_digests)
+    )
+
+
 def get_s3_file_as_text(s3_path):
     """
     Suitable only for small text files such as a script.
@@ -266,7 +1587,11 @@ def get_s3_file_as_text(s3_path):
     """
     try:
         bucket, path = parse_s3_path(s3_path)
-        s3 = boto3.resource("s3")
+        cache = s3cache.object_cache
+        if cache is not None:
+            with cache.open(bucket, path) as fo:
+                return fo.read().decode("utf-8")
+        s3 = get_resource("s3")
         file_obj = s3.Object(bucket, path)
         data = file_obj.get()["Body"].read()
         return data.decode("utf-8")
@@ -0,0 +1,294 @@
+"""Asyncio counterparts of the core s3api functions.
+
+Every request goes through one aiobotocore client, so they share its
+connection pool, and a semaphore caps the requests in flight. Avro
+decoding runs in the default executor to keep the event loop free.
+
+Example:
+```
+async with AsyncS3API(max_concurrency=256) as s3:
+    texts = await asyncio.gather(*(s3.get_s3_file_as_text(p) for p in paths))
+```
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+
+import botocore.exceptions
+import fastavro
+import pandas as pd
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from avrocodec import ColumnarAvroDecoder
+from s3api import parse_s3_path
+from s3cache import invalidate_listing
+
+from shared.awsclients import get_client_config, get_endpoint
+from shared.utils import chunked
+
+
+class AsyncS3API(object):
+    """
+    An async s3 api to use as an async context manager. At most
+    max_concurrency requests are in flight at once, and the client
+    connection pool is sized to match. The endpoint registered with
+    awsclients.set_endpoint is used unless endpoint_url is given.
+    """
+
+    def __init__(self, max_concurrency=128, region_name=None, endpoint_url=None):
+
+        self._max_concurrency = max_concurrency
+        self._region_name = region_name
+        self._endpoint_url = endpoint_url or get_endpoint("s3")
+        self._semaphore = None
+        self._client = None
+        self._exit_stack = None
+
+    async def __aenter__(self):
+
+        config = get_client_config()
+        config["max_pool_connections"] = self._max_concurrency
+        self._exit_stack = contextlib.AsyncExitStack()
+        self._client = await self._exit_stack.enter_async_context(
+            get_session().create_client(
+                "s3",
+                region_name=self._region_name,
+                endpoint_url=self._endpoint_url,
+                config=AioConfig(**config),
+            )
+        )
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+
+        await self._exit_stack.aclose()
+        self._client = None
+
+    async def _call(self, operation, **kwargs):
+
+        async with self._semaphore:
+            return await getattr(self._client, operation)(**kwargs)
+
+    async def _list_level(self, bucket, prefix, delimiter="/"):
+
+        objects = []
+        common_prefixes = []
+        kwargs = {"Bucket": bucket, "Prefix": prefix}
+        if delimiter is not None:
+            kwargs["Delimiter"] = delimiter
+        while True:
+            page = await self._call("list_objects_v2", **kwargs)
+            objects.extend(page.get("Contents", []))
+            common_prefixes.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+            if not page.get("IsTruncated"):
+                return objects, common_prefixes
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+    async def list_s3_objects(self, s3_path, max_depth=4):
+        """
+        Returns every object under the s3 path. The sub-prefixes are
+        discovered level by level and listed concurrently, see
+        s3api.iterate_s3_objects.
+
+        parameters:
+        ----------
+        s3_path: a full s3 path
+        max_depth: the maximum number of prefix levels to discover
+
+        return
+        ------
+        a list of object dicts with Key, Size, ETag and LastModified
+        """
+        bucket, prefix = parse_s3_path(s3_path)
+        objects = []
+        leaves = [prefix]
+        for depth in range(max_depth):
+            if len(leaves) >= self._max_concurrency:
+                break
+            levels = await asyncio.gather(
+                *(self._list_level(bucket, leaf) for leaf in leaves)
+            )
+            leaves = []
+            for level_objects, common_prefixes in levels:
+                objects.extend(level_objects)
+                leaves.extend(common_prefixes)
+            if not leaves:
+                return objects
+
+        for leaf_objects, _ in await asyncio.gather(
+            *(self._list_level(bucket, leaf, None) for leaf in leaves)
+        ):
+            objects.extend(leaf_objects)
+        return objects
+
+    async def get_files_s3_path_by_path(self, s3_path):
+        """
+        Returns a list of files under the s3 path in full s3 path.
+        """
+        bucket, prefix = parse_s3_path(s3_path)
+        return [
+            "s3://{}/{}".format(bucket, item["Key"])
+            for item in await self.list_s3_objects(s3_path)
+        ]
+
+    async def check_for_file_s3_path(self, s3_path):
+        """check whether s3 path is valid"""
+
+        bucket, key = parse_s3_path(s3_path)
+        try:
+            await self._call("head_object", Bucket=bucket, Key=key)
+            return True
+        except botocore.exceptions.ClientError:
+            return False
+
+    async def check_for_files_s3_paths(self, s3_paths):
+        """
+        Returns a dict of s3 path to exists, checking every path
+        concurrently.
+        """
+        found = await asyncio.gather(
+            *(self.check_for_file_s3_path(s3_path) for s3_path in s3_paths)
+        )
+        return dict(zip(s3_paths, found))
+
+    async def _get_bytes(self, s3_path):
+
+        bucket, key = parse_s3_path(s3_path)
+        async with self._semaphore:
+            response = await self._client.get_object(Bucket=bucket, Key=key)
+            async with response["Body"] as stream:
+                return await stream.read()
+
+    async def get_s3_file_as_text(self, s3_path):
+        """
+        Suitable only for small text files such as a script.
+        """
+        data = await self._get_bytes(s3_path)
+        return data.decode("utf-8")
+
+    async def read_s3_avro_file(self, s3_filename, schema=None, columns=None):
+        """
+        Reads from s3 based avro file and returns a pandas dataframe,
+        see s3api.read_s3_avro_file for schema and columns.
+        """
+        data = await self._get_bytes(s3_filename)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, _decode_avro_bytes, data, schema, columns
+        )
+
+    async def upload_file_to_s3(
+        self, filename, s3_path, multipart_chunksize=64 * 1024 * 1024
+    ):
+        """
+        uploads the given file to s3, files larger than
+        multipart_chunksize are uploaded in concurrent parts.
+        """
+        bucket, key = parse_s3_path(s3_path)
+        loop = asyncio.get_running_loop()
+        size = os.path.getsize(filename)
+        if size <= multipart_chunksize:
+            data = await loop.run_in_executor(None, _read_file, filename)
+            await self._call("put_object", Bucket=bucket, Key=key, Body=data)
+            invalidate_listing(bucket, key)
+            return
+
+        upload_id = (
+            await self._call("create_multipart_upload", Bucket=bucket, Key=key)
+        )["UploadId"]
+        part_count = (size + multipart_chunksize - 1) // multipart_chunksize
+        try:
+            parts = await asyncio.gather(
+                *(
+                    self._upload_part(
+                        filename, bucket, key, upload_id, number, multipart_chunksize
+                    )
+                    for number in range(1, part_count + 1)
+                )
+            )
+            await self._call(
+                "complete_multipart_upload",
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            await self._call(
+                "abort_multipart_upload", Bucket=bucket, Key=key, UploadId=upload_id
+            )
+            raise
+        invalidate_listing(bucket, key)
+
+    async def _upload_part(self, filename, bucket, key, upload_id, number, part_size):
+
+        loop = asyncio.get_running_loop()
+        # read under the semaphore so only the parts in flight are in memory
+        async with self._semaphore:
+            data = await loop.run_in_executor(
+                None, _read_file, filename, (number - 1) * part_size, part_size
+            )
+            response = await self._client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=number,
+                Body=data,
+            )
+        return {"ETag": response["ETag"], "PartNumber": number}
+
+    async def delete_s3_folder(self, bucket, prefix):
+        """
+        Deletes every object under the prefix with concurrent
+        DeleteObjects batches, returns the number of objects deleted
+        and the per key errors. A batch whose request failed has an
+        error for each of its keys, the other batches still run.
+        """
+        objects = await self.list_s3_objects("s3://{}/{}".format(bucket, prefix))
+        batches = list(chunked(objects, 1000))
+        responses = await asyncio.gather(
+            *(
+                self._call(
+                    "delete_objects",
+                    Bucket=bucket,
+                    Delete={
+                        "Objects": [{"Key": item["Key"]} for item in batch],
+                        "Quiet": True,
+                    },
+                )
+                for batch in batches
+            ),
+            return_exceptions=True,
+        )
+        invalidate_listing(bucket, prefix)
+        errors = {}
+        for batch, response in zip(batches, responses):
+            if isinstance(response, BaseException):
+                if not isinstance(response, Exception):
+                    raise response
+                # every key of a failed request is left in place
+                errors.update((item["Key"], repr(response)) for item in batch)
+                continue
+            errors.update(
+                (e["Key"], e.get("Message", e.get("Code")))
+                for e in response.get("Errors", [])
+            )
+        return {"objects": len(objects) - len(errors), "errors": errors}
+
+
+def _read_file(filename, offset=0, size=-1):
+
+    with open(filename, "rb") as fin:
+        fin.seek(offset)
+        return fin.read(size)
+
+
+def _decode_avro_bytes(data, schema=None, columns=None):
+
+    fo = io.BytesIO(data)
+    if schema is not None:
+        return ColumnarAvroDecoder(schema, columns).read(fo)
+    return pd.DataFrame(fastavro.reader(fo))
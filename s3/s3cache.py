@@ -0,0 +1,265 @@
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from shared.awsclients import get_client
+
+
+class ListingCache(object):
+    """
+    A size bounded LRU cache of s3 listings keyed by bucket and
+    prefix. Entries expire after ttl seconds unless they are pinned,
+    which is meant for closed partitions that will not change
+    anymore. Writers call invalidate on the prefixes they touch.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300):
+
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bucket, prefix):
+        """
+        Returns the cached listing or None when there is no fresh entry.
+        """
+        with self._lock:
+            entry = self._entries.get((bucket, prefix))
+            if entry is not None:
+                objects, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end((bucket, prefix))
+                    self.hits += 1
+                    return objects
+                del self._entries[(bucket, prefix)]
+            self.misses += 1
+            return None
+
+    def put(self, bucket, prefix, objects, pinned=False):
+        """
+        Caches a listing, pinned entries never expire.
+        """
+        expires_at = None if pinned else time.monotonic() + self._ttl
+        with self._lock:
+            self._entries[(bucket, prefix)] = (objects, expires_at)
+            self._entries.move_to_end((bucket, prefix))
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, bucket, prefix=""):
+        """
+        Drops every listing of the bucket that a change under the
+        prefix can affect: the listings of the parent prefixes as
+        well as the ones below it.
+        """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                entry_bucket, entry_prefix = key
+                if entry_bucket == bucket and (
+                    prefix.startswith(entry_prefix) or entry_prefix.startswith(prefix)
+                ):
+                    del self._entries[key]
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# the process wide listing cache, disabled until enable_listing_cache
+listing_cache = None
+
+
+def enable_listing_cache(max_entries=1024, ttl=300):
+    """
+    Turns on the listing cache used by the s3api listing functions.
+
+    parameters:
+    -----------
+    max_entries: the maximum number of cached listings
+    ttl: the number of seconds a listing that is not pinned stays fresh
+
+    return
+    ------
+    the listing cache
+    """
+    global listing_cache
+    listing_cache = ListingCache(max_entries, ttl)
+    return listing_cache
+
+
+def disable_listing_cache():
+
+    global listing_cache
+    listing_cache = None
+
+
+def invalidate_listing(bucket, prefix=""):
+    """
+    Drops the cached listings affected by a change under the prefix.
+    """
+    if listing_cache is not None:
+        listing_cache.invalidate(bucket, prefix)
+
+
+class ObjectCache(object):
+    """
+    An on disk cache of s3 objects with an LRU size limit, safe to
+    share between processes. Entries are named after the object's
+    ETag, so a hit costs one HEAD request instead of a download.
+    Files are written to a temporary name and renamed into place,
+    so readers never see a partial file. Temporary files count
+    against max_bytes, and the ones not written to for tmp_max_age
+    seconds, left by a process killed mid download, are removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3, tmp_max_age=900):
+
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._tmp_max_age = tmp_max_age
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_prefix(self, bucket, key):
+
+        digest = hashlib.sha1("{}/{}".format(bucket, key).encode("utf-8"))
+        return os.path.join(self._cache_dir, digest.hexdigest())
+
+    def _entry_path(self, bucket, key, etag):
+
+        return "{}-{}".format(self._entry_prefix(bucket, key), etag.strip('"'))
+
+    def open(self, bucket, key):
+        """
+        Returns a binary file object with the content of the object,
+        downloading it when the cached copy is missing or stale.
+        """
+        client = get_client("s3")
+        etag = client.head_object(Bucket=bucket, Key=key)["ETag"]
+        try:
+            fo = open(self._entry_path(bucket, key, etag), "rb")
+        except FileNotFoundError:
+            pass
+        else:
+            # touch the entry for the LRU eviction
+            os.utime(fo.fileno())
+            with self._lock:
+                self.hits += 1
+                self.bytes_saved += os.fstat(fo.fileno()).st_size
+            return fo
+
+        response = client.get_object(Bucket=bucket, Key=key)
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                shutil.copyfileobj(response["Body"], fout, 1024 * 1024)
+            entry_path = self._entry_path(bucket, key, response["ETag"])
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            # removed by another process when the download stalled
+            _remove_quietly(tmp_path)
+            raise
+        # an open file stays readable even if another process evicts it
+        fo = open(entry_path, "rb")
+        with self._lock:
+            self.misses += 1
+        for stale_path in glob.glob(self._entry_prefix(bucket, key) + "-*"):
+            if stale_path != entry_path:
+                _remove_quietly(stale_path)
+        self._evict(keep=entry_path)
+        return fo
+
+    def _evict(self, keep=None):
+        """
+        Removes the abandoned temporary files, then the least
+        recently used entries above max_bytes.
+        """
+        entries = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self._cache_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(".tmp"):
+                # a download in progress keeps its mtime fresh
+                if now - stat.st_mtime > self._tmp_max_age:
+                    _remove_quietly(entry.path)
+                else:
+                    total += stat.st_size
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total += sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            if path == keep:
+                continue
+            _remove_quietly(path)
+            total -= size
+
+    def stats(self):
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes_saved": self.bytes_saved,
+            }
+
+
+def _remove_quietly(path):
+
+    # another process may have removed it already
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# the process wide object cache, disabled until enable_object_cache
+object_cache = None
+
+
+def enable_object_cache(cache_dir, max_bytes=10 * 1024**3, tmp_max_age=900):
+    """
+    Turns on the on disk object cache used by get_s3_file_as_text
+    and read_s3_avro_file.
+
+    parameters:
+    -----------
+    cache_dir: the local cache directory, can be shared by processes
+    max_bytes: the size limit of the cache directory
+    tmp_max_age: the seconds after which an unfinished download is
+                 considered abandoned and removed
+
+    return
+    ------
+    the object cache
+    """
+    global object_cache
+    object_cache = ObjectCache(cache_dir, max_bytes, tmp_max_age)
+    return object_cache
+
+
+def disable_object_cache():
+
+    global object_cache
+    object_cache = None
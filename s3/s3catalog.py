@@ -0,0 +1,304 @@
+"""A persistent catalog of metastore databases and tables.
+
+The catalog is a SQLite file, so one file can be shared by every
+process of a host (or a network file system). Each call opens its
+own short transaction, which keeps it safe across threads and
+forked processes. The file is only opened on first use.
+
+Example:
+```
+metastore = Metastore("prod", catalog="/etc/etl/catalog.db")
+table = metastore.get_table("events", "clicks")  # loaded on demand
+```
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+_create_statements = (
+    """
+    CREATE TABLE IF NOT EXISTS databases (
+        name TEXT PRIMARY KEY,
+        root_path TEXT NOT NULL,
+        default_partition TEXT,
+        schema_store TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tables (
+        database TEXT NOT NULL,
+        name TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        root_path TEXT NOT NULL,
+        schema TEXT,
+        partition_type TEXT,
+        partition_descriptor TEXT,
+        storage_format TEXT NOT NULL,
+        PRIMARY KEY (database, name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS partition_discoveries (
+        database TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        discovered_at REAL NOT NULL,
+        PRIMARY KEY (database, table_name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS partitions (
+        database TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        partition_values TEXT NOT NULL,
+        files INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        PRIMARY KEY (database, table_name, partition_values)
+    )
+    """,
+)
+
+_table_columns = (
+    "database",
+    "name",
+    "kind",
+    "root_path",
+    "schema",
+    "partition_type",
+    "partition_descriptor",
+    "storage_format",
+)
+
+
+class SQLiteStore(object):
+    """
+    A SQLite file shared by processes, created with the
+    create_statements of the subclass on first use. Writers wait
+    up to timeout seconds for a lock held by another process.
+    """
+
+    create_statements = ()
+
+    def __init__(self, path, timeout=30.0):
+
+        self._path = path
+        self._timeout = timeout
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path
+
+    def _connect(self):
+
+        if self._initialized:
+            conn = sqlite3.connect(self._path, timeout=self._timeout)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=self._timeout)
+            conn.row_factory = sqlite3.Row
+            # readers do not block the writer of another process
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                for statement in self.create_statements:
+                    conn.execute(statement)
+            self._initialized = True
+        return conn
+
+    def _execute(self, statement, parameters=()):
+
+        conn = self._connect()
+        try:
+            with conn:
+                return conn.execute(statement, parameters).fetchall()
+        finally:
+            conn.close()
+
+
+class SQLiteCatalog(SQLiteStore):
+    """
+    Stores the databases and the tables of a metastore, and the
+    partitions discovered for them, as plain rows; the metastore
+    turns them back into Database and Table objects.
+    """
+
+    create_statements = _create_statements
+
+    def put_database(self, name, root_path, default_partition=None, schema_store=None):
+
+        self._execute(
+            "INSERT OR REPLACE INTO databases VALUES (?, ?, ?, ?)",
+            (name, root_path, default_partition, schema_store),
+        )
+
+    def get_database(self, name):
+        """
+        Returns the database row as a dict, None when it is unknown.
+        """
+        rows = self._execute("SELECT * FROM databases WHERE name = ?", (name,))
+        return dict(rows[0]) if rows else None
+
+    def list_databases(self):
+
+        return [
+            row["name"]
+            for row in self._execute("SELECT name FROM databases ORDER BY name")
+        ]
+
+    def delete_database(self, name):
+        """
+        Removes the database and every table of it.
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                for catalog_table in ("partitions", "partition_discoveries"):
+                    conn.execute(
+                        "DELETE FROM {} WHERE database = ?".format(catalog_table),
+                        (name,),
+                    )
+                conn.execute("DELETE FROM tables WHERE database = ?", (name,))
+                conn.execute("DELETE FROM databases WHERE name = ?", (name,))
+        finally:
+            conn.close()
+
+    def put_table(
+        self,
+        database,
+        name,
+        kind,
+        root_path,
+        schema=None,
+        partition_type=None,
+        partition_descriptor=None,
+        storage_format="avro",
+    ):
+
+        if partition_descriptor is not None:
+            partition_descriptor = json.dumps(list(partition_descriptor))
+        self._execute(
+            "INSERT OR REPLACE INTO tables VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                database,
+                name,
+                kind,
+                root_path,
+                schema,
+                partition_type,
+                partition_descriptor,
+                storage_format,
+            ),
+        )
+
+    def get_tables(self, database):
+        """
+        Returns the table rows of the database as dicts.
+        """
+        tables = []
+        for row in self._execute(
+            "SELECT {} FROM tables WHERE database = ? ORDER BY name".format(
+                ", ".join(_table_columns)
+            ),
+            (database,),
+        ):
+            table = dict(row)
+            if table["partition_descriptor"] is not None:
+                table["partition_descriptor"] = tuple(
+                    json.loads(table["partition_descriptor"])
+                )
+            tables.append(table)
+        return tables
+
+    def delete_table(self, database, name):
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "DELETE FROM tables WHERE database = ? AND name = ?",
+                    (database, name),
+                )
+                self._delete_partitions(conn, database, name)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _delete_partitions(conn, database, table_name):
+
+        for catalog_table in ("partitions", "partition_discoveries"):
+            conn.execute(
+                "DELETE FROM {} WHERE database = ? AND table_name = ?".format(
+                    catalog_table
+                ),
+                (database, table_name),
+            )
+
+    def put_partitions(self, database, table_name, partitions):
+        """
+        Replaces the discovered partitions of a table.
+
+        parameters:
+        -----------
+        database: the database name
+        table_name: the table name
+        partitions: a list of dicts with the partition "values"
+                    tuple and its "files" and "bytes" totals
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                self._delete_partitions(conn, database, table_name)
+                conn.executemany(
+                    "INSERT INTO partitions VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (
+                            database,
+                            table_name,
+                            json.dumps(list(partition["values"])),
+                            partition["files"],
+                            partition["bytes"],
+                        )
+                        for partition in partitions
+                    ],
+                )
+                conn.execute(
+                    "INSERT INTO partition_discoveries VALUES (?, ?, ?)",
+                    (database, table_name, time.time()),
+                )
+        finally:
+            conn.close()
+
+    def get_partitions(self, database, table_name, max_age=None):
+        """
+        Returns the discovered partitions of a table as dicts with
+        the "values" tuple, "files" and "bytes", None when the table
+        was never discovered or the discovery is older than max_age
+        seconds.
+        """
+        discoveries = self._execute(
+            "SELECT discovered_at FROM partition_discoveries "
+            "WHERE database = ? AND table_name = ?",
+            (database, table_name),
+        )
+        if not discoveries:
+            return None
+        if max_age is not None and discoveries[0][0] + max_age < time.time():
+            return None
+        return [
+            {
+                "values": tuple(json.loads(row["partition_values"])),
+                "files": row["files"],
+                "bytes": row["bytes"],
+            }
+            for row in self._execute(
+                "SELECT partition_values, files, bytes FROM partitions "
+                "WHERE database = ? AND table_name = ? ORDER BY partition_values",
+                (database, table_name),
+            )
+        ]
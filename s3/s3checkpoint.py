@@ -0,0 +1,310 @@
+"""Incremental processing checkpoints for metastore tables.
+
+A checkpoint store records, per table, consumer and partition, the
+keys and ETags of the files a consumer already processed. The
+incremental listing then returns only the files that are new or
+whose content changed since, so a job that runs every hour to pick
+up late files reads the delta and not the whole partitions again.
+
+Files are only recorded by commit_table_files, once the caller has
+processed them, which gives at least once processing. Compaction
+rewrites files under new keys, so a compacted partition is seen
+as new by every consumer.
+
+Example:
+```
+store = SQLiteCheckpointStore("/var/lib/etl/checkpoints.db")
+files = get_new_table_files(table, "billing", store, "2020-01-01", "2020-01-02")
+for item in files:
+    process(read_s3_avro_file(item["path"], schema=table.schema))
+commit_table_files(table, "billing", store, files)
+```
+"""
+
+import functools
+import hashlib
+import json
+import time
+
+import botocore.exceptions
+from s3api import (
+    is_hidden_key,
+    iterate_s3_objects,
+    ordered_parallel_map,
+    parse_s3_path,
+    plan_table_partitions,
+)
+from s3catalog import SQLiteStore
+
+from shared.awsclients import get_client
+
+_create_statements = (
+    """
+    CREATE TABLE IF NOT EXISTS processed_files (
+        table_key TEXT NOT NULL,
+        consumer TEXT NOT NULL,
+        partition TEXT NOT NULL,
+        key TEXT NOT NULL,
+        etag TEXT NOT NULL,
+        processed_at REAL NOT NULL,
+        PRIMARY KEY (table_key, consumer, partition, key)
+    )
+    """,
+)
+
+
+class SQLiteCheckpointStore(SQLiteStore):
+    """
+    Keeps the checkpoints in a local SQLite file, which can be
+    shared by the processes of a host.
+    """
+
+    create_statements = _create_statements
+
+    def get_processed(self, table_key, consumer, partition):
+        """
+        Returns the processed files of a partition as a dict of
+        key to etag.
+        """
+        rows = self._execute(
+            "SELECT key, etag FROM processed_files "
+            "WHERE table_key = ? AND consumer = ? AND partition = ?",
+            (table_key, consumer, partition),
+        )
+        return {row["key"]: row["etag"] for row in rows}
+
+    def mark_processed(self, table_key, consumer, partition, files):
+        """
+        Records files of a partition as processed.
+
+        parameters:
+        -----------
+        table_key: the table the files belong to, e.g. its root path
+        consumer: the name of the consuming job
+        partition: the partition path of the files
+        files: a dict of key to etag
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO processed_files "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (table_key, consumer, partition, key, etag, now)
+                        for key, etag in files.items()
+                    ],
+                )
+        finally:
+            conn.close()
+
+    def reset(self, table_key, consumer):
+        """
+        Forgets every checkpoint of the consumer on the table.
+        """
+        self._execute(
+            "DELETE FROM processed_files WHERE table_key = ? AND consumer = ?",
+            (table_key, consumer),
+        )
+
+
+class S3CheckpointStore(object):
+    """
+    Keeps the checkpoints as one json object per table, consumer
+    and partition under an s3 path, so jobs on any host share them.
+    A consumer must not run twice at the same time, the last
+    writer of a partition checkpoint wins.
+    """
+
+    def __init__(self, s3_path):
+
+        self._bucket, prefix = parse_s3_path(s3_path)
+        self._prefix = prefix.rstrip("/")
+
+    def _consumer_prefix(self, table_key, consumer):
+
+        digest = hashlib.sha1(table_key.encode("utf-8")).hexdigest()
+        return "{}/{}/{}/".format(self._prefix, consumer, digest).lstrip("/")
+
+    def _object_key(self, table_key, consumer, partition):
+
+        digest = hashlib.sha1(partition.encode("utf-8")).hexdigest()
+        return "{}{}.json".format(self._consumer_prefix(table_key, consumer), digest)
+
+    def get_processed(self, table_key, consumer, partition):
+        """
+        Returns the processed files of a partition as a dict of
+        key to etag.
+        """
+        try:
+            response = get_client("s3").get_object(
+                Bucket=self._bucket,
+                Key=self._object_key(table_key, consumer, partition),
+            )
+        except botocore.exceptions.ClientError as err:
+            if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return {}
+            raise
+        return json.loads(response["Body"].read())["files"]
+
+    def mark_processed(self, table_key, consumer, partition, files):
+        """
+        Records files of a partition as processed, see
+        SQLiteCheckpointStore.mark_processed.
+        """
+        processed = self.get_processed(table_key, consumer, partition)
+        processed.update(files)
+        body = json.dumps({"partition": partition, "files": processed})
+        get_client("s3").put_object(
+            Bucket=self._bucket,
+            Key=self._object_key(table_key, consumer, partition),
+            Body=body.encode("utf-8"),
+            ContentType="application/json",
+        )
+
+    def reset(self, table_key, consumer):
+        """
+        Forgets every checkpoint of the consumer on the table.
+        """
+        client = get_client("s3")
+        paginator = client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self._bucket, Prefix=self._consumer_prefix(table_key, consumer)
+        ):
+            keys = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+            if keys:
+                client.delete_objects(
+                    Bucket=self._bucket, Delete={"Objects": keys, "Quiet": True}
+                )
+
+
+def list_new_s3_files(s3_path, consumer, store, table_key=None):
+    """
+    Incremental listing of an s3 folder: returns the files that the
+    consumer has not processed yet, or whose etag changed since.
+
+    parameters:
+    -----------
+    s3_path: a full s3 folder path
+    consumer: the name of the consuming job
+    store: a SQLiteCheckpointStore or S3CheckpointStore
+    table_key: the checkpoint key of the table, defaults to s3_path
+
+    return
+    ------
+    a list of dicts with the file "path", "key", "etag", "size",
+    "table_key" and "partition"
+    """
+    bucket, prefix = parse_s3_path(s3_path)
+    partition = s3_path.rstrip("/")
+    table_key = table_key or partition
+    processed = store.get_processed(table_key, consumer, partition)
+    # never compare against a cached listing, it may miss late files
+    return [
+        {
+            "path": "s3://{}/{}".format(bucket, item["Key"]),
+            "key": item["Key"],
+            "etag": item["ETag"],
+            "size": item["Size"],
+            "table_key": table_key,
+            "partition": partition,
+        }
+        for item in iterate_s3_objects(
+            "s3://{}/{}/".format(bucket, prefix.rstrip("/")), use_cache=False
+        )
+        if item["Size"] > 0
+        and not is_hidden_key(item["Key"])
+        and processed.get(item["Key"]) != item["ETag"]
+    ]
+
+
+def get_new_table_files(
+    table, consumer, store, start, end=None, filters=None, max_workers=8
+):
+    """
+    Incremental listing of a table's partitions in the start/end
+    window, see list_new_s3_files. Filters on the partition columns
+    prune the partitions.
+
+    parameters:
+    -----------
+    table: a metastore Table, KinesisTable or S3TableWithPartition
+    consumer: the name of the consuming job
+    store: a SQLiteCheckpointStore or S3CheckpointStore
+    start: the first run date of the window
+    end: the last run date of the window, defaults to start
+    filters: a list of (column, op, value) tuples
+    max_workers: the number of partitions listed concurrently
+
+    return
+    ------
+    a list of dicts with the file "path", "key", "etag", "size",
+    "table_key" and "partition", in partition order
+    """
+    list_partition = functools.partial(
+        _list_new_partition_files,
+        consumer=consumer,
+        store=store,
+        table_key=table.path(),
+    )
+    partition_paths = [
+        partition_path
+        for _, partition_path in plan_table_partitions(table, start, end, filters)
+    ]
+    files = []
+    for partition_path, new_files, err in ordered_parallel_map(
+        list_partition, partition_paths, max_workers
+    ):
+        if err is not None:
+            raise err
+        files.extend(new_files)
+    return files
+
+
+def _list_new_partition_files(partition_path, consumer, store, table_key):
+
+    return list_new_s3_files(partition_path, consumer, store, table_key)
+
+
+def commit_s3_files(consumer, store, files):
+    """
+    Records the files returned by list_new_s3_files or
+    get_new_table_files as processed, to call once they have been
+    processed.
+
+    parameters:
+    -----------
+    consumer: the name of the consuming job
+    store: a SQLiteCheckpointStore or S3CheckpointStore
+    files: the file dicts of the incremental listing
+    """
+    partitions = {}
+    for item in files:
+        partition = (item["table_key"], item["partition"])
+        partitions.setdefault(partition, {})[item["key"]] = item["etag"]
+    for (table_key, partition), processed in partitions.items():
+        store.mark_processed(table_key, consumer, partition, processed)
+
+
+def commit_table_files(table, consumer, store, files):
+    """
+    Records the files returned by get_new_table_files as processed,
+    see commit_s3_files. Raises a ValueError when a file was not
+    listed from the table, so its checkpoint is not recorded under
+    another table.
+
+    parameters:
+    -----------
+    table: the table the files were listed from
+    consumer: the name of the consuming job
+    store: a SQLiteCheckpointStore or S3CheckpointStore
+    files: the file dicts of get_new_table_files
+    """
+    table_key = table.path()
+    for item in files:
+        if item["table_key"] != table_key:
+            raise ValueError(
+                "{} was not listed from table {}".format(item["path"], table.name)
+            )
+    commit_s3_files(consumer, store, files)
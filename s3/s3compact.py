@@ -0,0 +1,295 @@
+"""Small file compaction of the partitions of a metastore table.
+
+Firehose and other streaming writers leave many small avro files
+per partition, and every read pays the per object latency for each
+of them. Compaction merges the small files of a partition into files
+near a target size, re-encoded with the table's schema. The files
+are merged in groups; the old files of a group are deleted only
+after its new file is uploaded, so no record is ever lost.
+
+Between the upload and the delete the records of a group are in
+the partition twice. Old files that still fail to delete after a
+few attempts raise a GPExpTaskException naming them and the
+compacted file that holds their records; they are duplicates until
+they are deleted. A run that dies between the upload and the
+delete leaves the same duplicates behind, without the error.
+
+Example:
+```
+stats = compact_table_partitions(table, "2020-01-01", "2020-01-07")
+```
+"""
+
+import functools
+import io
+import logging
+import sys
+import time
+
+import fastavro
+from avrocodec import schema_registry
+from s3api import (
+    delete_s3_batch,
+    is_hidden_key,
+    iterate_s3_objects,
+    open_s3_object_stream,
+    ordered_parallel_map,
+    parse_s3_path,
+)
+from s3cache import invalidate_listing
+from s3manifest import read_partition_manifest, write_partition_manifest
+from s3writer import PartitionedAvroWriter
+
+from shared.etlexceptions import GPExpTaskException
+from shared.utils import chunked
+
+
+def plan_compaction(objects, target_file_size, small_file_size=None, min_files=2):
+    """
+    Packs the small files of a partition into groups of about
+    target_file_size bytes, each group becomes one output file.
+
+    parameters:
+    -----------
+    objects: the listed objects of the partition, dicts with Key and Size
+    target_file_size: the aimed size of a compacted file in bytes
+    small_file_size: the files below this size are compacted,
+                     defaults to half of target_file_size
+    min_files: the fewest small files worth compacting
+
+    return
+    ------
+    a list of groups, each a list of objects in key order
+    """
+    if small_file_size is None:
+        small_file_size = target_file_size // 2
+    small = sorted(
+        (item for item in objects if 0 < item["Size"] < small_file_size),
+        key=lambda item: item["Key"],
+    )
+    if len(small) < min_files:
+        return []
+
+    groups = [[]]
+    group_size = 0
+    for item in small:
+        if groups[-1] and group_size + item["Size"] > target_file_size:
+            groups.append([])
+            group_size = 0
+        groups[-1].append(item)
+        group_size += item["Size"]
+    # a lone file gains nothing from being rewritten
+    return [group for group in groups if len(group) > 1]
+
+
+def _fetch_object(bucket, item):
+
+    with open_s3_object_stream("s3://{}/{}".format(bucket, item["Key"])) as body:
+        return body.read()
+
+
+def _write_group(
+    table, rdate, bucket, group, schema, codec, fetch_workers, write_manifest
+):
+    """
+    Re-encodes the records of a group of files into one new file,
+    returns its full s3 path once it is uploaded.
+    """
+    writer = None
+    fetched = ordered_parallel_map(
+        functools.partial(_fetch_object, bucket), group, fetch_workers
+    )
+    try:
+        for item, data, err in fetched:
+            if err is not None:
+                raise err
+            records = fastavro.reader(io.BytesIO(data), reader_schema=schema)
+            if writer is None:
+                writer = PartitionedAvroWriter(
+                    table,
+                    schema=schema or records.writer_schema,
+                    # never roll, the file is only uploaded on close
+                    target_file_size=sys.maxsize,
+                    codec=codec,
+                    file_prefix="compacted",
+                    write_manifest=write_manifest,
+                )
+            writer.write(records, rdate=rdate)
+    except BaseException:
+        fetched.close()
+        if writer is not None:
+            writer.close(wait=False)
+        raise
+    return writer.close()
+
+
+def _delete_group(bucket, group, attempts=3, backoff=1.0):
+    """
+    Deletes the old files of a compacted group, retrying the keys
+    that failed. Returns the per key errors of the last attempt.
+    """
+    remaining = group
+    errors = {}
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        errors = {}
+        for batch in chunked(remaining, 1000):
+            try:
+                errors.update(delete_s3_batch(bucket, batch))
+            except Exception as err:
+                errors.update((item["Key"], repr(err)) for item in batch)
+        remaining = [item for item in remaining if item["Key"] in errors]
+        if not remaining:
+            break
+    return errors
+
+
+def compact_partition(
+    table,
+    rdate,
+    target_file_size=128 * 1024 * 1024,
+    small_file_size=None,
+    min_files=2,
+    codec="deflate",
+    fetch_workers=8,
+    dry_run=False,
+):
+    """
+    Merges the small files of one table partition.
+
+    parameters:
+    -----------
+    table: a metastore Table or KinesisTable stored as avro
+    rdate: the run date of the partition
+    target_file_size: the aimed size of a compacted file in bytes
+    small_file_size: the files below this size are compacted,
+                     defaults to half of target_file_size
+    min_files: the fewest small files worth compacting
+    codec: the avro codec of the compacted files
+    fetch_workers: the number of small files fetched concurrently
+    dry_run: a flag indicates whether to only plan the compaction
+
+    return
+    ------
+    a dict with the number of input files and bytes and the
+    output files. Raises a GPExpTaskException when old files could
+    not be deleted, their records are then also in the output.
+    """
+    bucket, prefix = parse_s3_path(table.path(rdate))
+    # never plan a compaction from the listing cache
+    objects = [
+        item
+        for item in iterate_s3_objects(
+            "s3://{}/{}/".format(bucket, prefix.rstrip("/")), use_cache=False
+        )
+        if not is_hidden_key(item["Key"])
+    ]
+    groups = plan_compaction(objects, target_file_size, small_file_size, min_files)
+    inputs = [item for group in groups for item in group]
+    stats = {
+        "rdate": rdate,
+        "input_files": len(inputs),
+        "input_bytes": sum(item["Size"] for item in inputs),
+        "output_files": [],
+        "dry_run": dry_run,
+    }
+    if dry_run or not inputs:
+        return stats
+
+    schema = None
+    if table.schema is not None:
+        schema = schema_registry.get(table.schema).schema
+    has_manifest = read_partition_manifest(table, rdate) is not None
+
+    # each group is swapped on its own, a failure leaves the
+    # partition with every record exactly once
+    for group in groups:
+        output_files = _write_group(
+            table, rdate, bucket, group, schema, codec, fetch_workers, has_manifest
+        )
+        stats["output_files"].extend(output_files)
+
+        errors = _delete_group(bucket, group)
+        invalidate_listing(bucket, prefix)
+        if has_manifest:
+            removed = [item["Key"] for item in group if item["Key"] not in errors]
+            write_partition_manifest(table, rdate, [], remove=removed)
+        if errors:
+            raise GPExpTaskException(
+                "Failed to delete {} files of {} compacted into {}, their records "
+                "are duplicated until they are deleted: {}".format(
+                    len(errors),
+                    table.path(rdate),
+                    ", ".join(output_files),
+                    ", ".join(sorted(errors)),
+                ),
+                errors=errors,
+            )
+
+    logging.info(
+        "Compacted {} files, {} bytes of {} into {} files".format(
+            stats["input_files"],
+            stats["input_bytes"],
+            table.path(rdate),
+            len(stats["output_files"]),
+        )
+    )
+    return stats
+
+
+def compact_table_partitions(
+    table,
+    start,
+    end=None,
+    target_file_size=128 * 1024 * 1024,
+    small_file_size=None,
+    min_files=2,
+    codec="deflate",
+    max_workers=4,
+    dry_run=False,
+):
+    """
+    Compacts the partitions of a table in the start/end window,
+    max_workers partitions at a time. See compact_partition.
+
+    parameters:
+    -----------
+    table: a metastore Table or KinesisTable stored as avro
+    start: the first run date of the window
+    end: the last run date of the window, defaults to start
+    max_workers: the number of partitions compacted concurrently
+
+    return
+    ------
+    a list of the compact_partition stats of every partition
+    """
+    if table.storage_format != "avro":
+        raise ValueError("Only avro tables can be compacted")
+
+    compact = functools.partial(
+        compact_partition,
+        table,
+        target_file_size=target_file_size,
+        small_file_size=small_file_size,
+        min_files=min_files,
+        codec=codec,
+        dry_run=dry_run,
+    )
+    results = []
+    errors = {}
+    for rdate, stats, err in ordered_parallel_map(
+        compact, table.partition_dates(start, end), max_workers
+    ):
+        if err is not None:
+            logging.error("Failed to compact {}: {!r}".format(table.path(rdate), err))
+            errors[rdate] = err
+            continue
+        results.append(stats)
+
+    if errors:
+        raise GPExpTaskException(
+            "Failed to compact {} partitions of {}".format(len(errors), table.name),
+            errors=errors,
+        )
+    return results
@@ -0,0 +1,349 @@
+"""Partition manifests: one json object per table partition that
+lists the partition's data files with their size, ETag, row count
+and per column min/max.
+
+A reader plans a partition from a single GET of the manifest
+instead of a LIST, and skips the files whose stats rule out its
+filters. Manifests are written by the PartitionedAvroWriter
+(write_manifest=True) or by index_table_partitions. Files added to
+a partition by other means are not seen until it is re-indexed.
+
+Updates are conditional on the ETag of the manifest they read, and
+are retried on a conflict, so writers closing on the same partition
+at the same time, or a writer racing a compaction, never drop each
+other's entries. index_table_partitions replaces a manifest as a
+whole and is not meant to run next to writers of the partition.
+"""
+
+import json
+import logging
+import random
+import time
+
+import botocore.exceptions
+import numpy as np
+import pandas as pd
+from predicates import stats_rule_out
+from s3api import (
+    is_hidden_key,
+    iterate_s3_objects,
+    ordered_parallel_map,
+    parse_s3_path,
+    read_s3_avro_file,
+)
+from s3cache import invalidate_listing
+
+from shared.awsclients import get_client
+from shared.etlexceptions import GPExpTaskException
+
+# the manifest object name, data file listings skip names
+# starting with an underscore
+manifest_name = "_manifest.json"
+
+manifest_version = 1
+
+# the error codes of a conditional write that lost a race
+_write_conflicts = ("PreconditionFailed", "ConditionalRequestConflict", "412", "409")
+
+
+def manifest_path(table, rdate=None):
+    """
+    Returns the full s3 path of the manifest of a table partition.
+    """
+    if rdate is not None:
+        # any date within the partition, as a string or pd.Timestamp
+        rdate = table.partition_dates(rdate)[0]
+    return "{}/{}".format(table.path(rdate).rstrip("/"), manifest_name)
+
+
+def _to_json_value(value):
+
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return pd.Timestamp(value).isoformat(), "timestamp"
+    if isinstance(value, np.generic):
+        return value.item(), None
+    return value, None
+
+
+def column_stats(df):
+    """
+    Returns the min/max of every column of the dataframe whose
+    values are ordered. Missing values are ignored.
+
+    parameters:
+    -----------
+    df: a panda dataframe
+
+    return
+    ------
+    a dict of column to {"min", "max"} of python values
+    """
+    stats = {}
+    for column in df.columns:
+        values = df[column].dropna()
+        if len(values) == 0 or values.dtype == bool:
+            continue
+        try:
+            low, high = values.min(), values.max()
+        except TypeError:
+            # mixed types or unordered objects such as dicts
+            continue
+        if isinstance(low, (str, int, float, np.generic, pd.Timestamp)):
+            stats[column] = {"min": low, "max": high}
+    return stats
+
+
+def merge_column_stats(stats, other):
+    """
+    Returns the stats covering the rows of both stats dicts. A
+    column missing from either one has unknown bounds and is
+    dropped.
+    """
+    if stats is None:
+        return dict(other)
+    merged = {}
+    for column in set(stats) & set(other):
+        try:
+            merged[column] = {
+                "min": min(stats[column]["min"], other[column]["min"]),
+                "max": max(stats[column]["max"], other[column]["max"]),
+            }
+        except TypeError:
+            continue
+    return merged
+
+
+def manifest_entry(s3_filename, size, etag, rows, stats):
+    """
+    Returns the manifest entry of a data file.
+
+    parameters:
+    -----------
+    s3_filename: the data file in full s3 path
+    size: the object size in bytes
+    etag: the object etag
+    rows: the number of rows of the file
+    stats: the column stats of the file, see column_stats
+    """
+    encoded = {}
+    for column, bounds in (stats or {}).items():
+        low, kind = _to_json_value(bounds["min"])
+        high, _ = _to_json_value(bounds["max"])
+        encoded[column] = {"min": low, "max": high}
+        if kind is not None:
+            encoded[column]["type"] = kind
+    return {
+        "key": parse_s3_path(s3_filename)[1],
+        "size": int(size),
+        "etag": etag,
+        "rows": int(rows),
+        "stats": encoded,
+    }
+
+
+def write_partition_manifest(
+    table, rdate, entries, merge=True, remove=None, max_attempts=10
+):
+    """
+    Writes the manifest of a table partition.
+
+    parameters:
+    -----------
+    table: a metastore Table or KinesisTable
+    rdate: the run date of the partition
+    entries: a list of manifest entries, see manifest_entry
+    merge: a flag indicates whether to keep the entries of the
+           existing manifest, an entry with the same key is replaced
+    remove: the keys of the existing entries to drop, e.g. the
+            files replaced by a compaction
+    max_attempts: the number of tries when another writer updates
+                  the manifest at the same time
+
+    return
+    ------
+    the manifest in full s3 path
+    """
+    s3_path = manifest_path(table, rdate)
+    bucket, key = parse_s3_path(s3_path)
+    for attempt in range(max_attempts):
+        files = {}
+        condition = {}
+        if merge:
+            existing, etag = _get_manifest(s3_path)
+            if existing is not None:
+                files = {entry["key"]: entry for entry in existing["files"]}
+            # only replace the manifest that was read
+            condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        for removed in remove or []:
+            files.pop(removed, None)
+        files.update((entry["key"], entry) for entry in entries)
+
+        body = json.dumps(
+            {
+                "version": manifest_version,
+                "files": [files[name] for name in sorted(files)],
+            }
+        )
+        try:
+            get_client("s3").put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=body.encode("utf-8"),
+                ContentType="application/json",
+                **condition
+            )
+        except botocore.exceptions.ClientError as err:
+            if err.response["Error"]["Code"] not in _write_conflicts:
+                raise
+            time.sleep(random.uniform(0, min(0.1 * 2**attempt, 2.0)))
+            continue
+        invalidate_listing(bucket, key)
+        return s3_path
+
+    raise GPExpTaskException(
+        "Failed to update {} after {} conflicting writes".format(s3_path, max_attempts)
+    )
+
+
+def _get_manifest(s3_path):
+    """
+    Returns the manifest and its etag, (None, None) when it does
+    not exist.
+    """
+    bucket, key = parse_s3_path(s3_path)
+    try:
+        response = get_client("s3").get_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as err:
+        if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None, None
+        raise
+    return json.loads(response["Body"].read()), response["ETag"]
+
+
+def read_partition_manifest(table, rdate=None):
+    """
+    Returns the manifest of a table partition, None when the
+    partition has no manifest. Timestamp bounds are decoded back
+    into pd.Timestamp.
+
+    return
+    ------
+    a dict with a "files" list of manifest entries
+    """
+    manifest, _ = _get_manifest(manifest_path(table, rdate))
+    if manifest is None:
+        return None
+    for entry in manifest["files"]:
+        for bounds in entry["stats"].values():
+            if bounds.get("type") == "timestamp":
+                bounds["min"] = pd.Timestamp(bounds["min"])
+                bounds["max"] = pd.Timestamp(bounds["max"])
+    return manifest
+
+
+def entry_ruled_out(entry, filters=None):
+    """
+    Returns True when the file stats of the entry rule out any
+    of the (column, op, value) filters.
+    """
+    if entry["rows"] == 0:
+        return True
+    for column, op, value in filters or []:
+        bounds = entry["stats"].get(column)
+        if bounds is not None and stats_rule_out(
+            bounds["min"], bounds["max"], op, value
+        ):
+            return True
+    return False
+
+
+def plan_partition_files(table, rdate, filters=None):
+    """
+    Returns the data files of a table partition from its
+    manifest, without the files ruled out by the filters.
+
+    return
+    ------
+    a list of file names in full s3 path, None when the partition
+    has no manifest
+    """
+    manifest = read_partition_manifest(table, rdate)
+    if manifest is None:
+        return None
+    bucket, _ = parse_s3_path(table.path(rdate))
+    return [
+        "s3://{}/{}".format(bucket, entry["key"])
+        for entry in manifest["files"]
+        if not entry_ruled_out(entry, filters)
+    ]
+
+
+def index_table_partitions(table, start, end=None, max_workers=8):
+    """
+    Builds the manifests of a table's partitions in the start/end
+    window from their current files. Every file is read once to
+    count its rows and compute its column stats.
+
+    parameters:
+    -----------
+    table: a metastore Table or KinesisTable
+    start: the first run date of the window
+    end: the last run date of the window, defaults to start
+    max_workers: the number of files read concurrently
+
+    return
+    ------
+    the list of manifests written in full s3 path
+    """
+    manifests = []
+    for rdate in table.partition_dates(start, end):
+        bucket, prefix = parse_s3_path(table.path(rdate))
+        objects = {
+            "s3://{}/{}".format(bucket, item["Key"]): item
+            for item in iterate_s3_objects(
+                "s3://{}/{}/".format(bucket, prefix.rstrip("/"))
+            )
+            if item["Size"] > 0 and not is_hidden_key(item["Key"])
+        }
+        if not objects:
+            continue
+
+        entries = []
+        errors = {}
+        for s3_filename, df, err in ordered_parallel_map(
+            _read_for_index(table), list(objects), max_workers
+        ):
+            if err is not None:
+                logging.error("Failed to index {}: {!r}".format(s3_filename, err))
+                errors[s3_filename] = err
+                continue
+            item = objects[s3_filename]
+            entries.append(
+                manifest_entry(
+                    s3_filename, item["Size"], item["ETag"], len(df), column_stats(df)
+                )
+            )
+        # a partial manifest would hide the failed files from readers
+        if errors:
+            raise GPExpTaskException(
+                "Failed to index {} of {} files of {}".format(
+                    len(errors), len(objects), table.name
+                ),
+                errors=errors,
+            )
+        manifests.append(write_partition_manifest(table, rdate, entries, merge=False))
+    return manifests
+
+
+def _read_for_index(table):
+
+    def read(s3_filename):
+        if table.storage_format == "parquet":
+            from parquetio import read_s3_parquet_file
+
+            return read_s3_parquet_file(s3_filename)
+        if table.schema is None:
+            return read_s3_avro_file(s3_filename, streaming=True)
+        return read_s3_avro_file(s3_filename, schema=table.schema)
+
+    return read
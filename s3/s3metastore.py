@@ -1,14 +1,101 @@
-import json
+import functools
+import numbers
 import os
 from collections import defaultdict
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 import pkg_resources
-from s3api import parse_s3_path
+from avrocodec import schema_registry
+from s3api import (
+    discover_s3_partitions,
+    filter_existing_s3_prefixes,
+    parse_s3_path,
+    scan_table,
+)
+from s3catalog import SQLiteCatalog
 
 timestamp_format = "%Y-%m-%dT%H:%M:%S"
 
+storage_formats = ("avro", "parquet")
+
+# step between two consecutive partitions of each partition type
+partition_offsets = {
+    "ymd": pd.offsets.Day(),
+    "ymdh": pd.offsets.Hour(),
+    "ym": pd.offsets.MonthBegin(),
+    "y": pd.offsets.YearBegin(),
+}
+
+# the partition columns in the path of each partition type, the y
+# partitions only keep the year although their path has a month
+partition_columns = {
+    "ymd": ("year", "month", "day"),
+    "ymdh": ("year", "month", "day", "hour"),
+    "ym": ("year", "month"),
+    "y": ("year",),
+}
+
+# numpy datetime64 unit of each partition type
+partition_units = {
+    "ymd": "datetime64[D]",
+    "ymdh": "datetime64[h]",
+    "ym": "datetime64[M]",
+    "y": "datetime64[Y]",
+}
+
+
+def partition_starts(timestamps, partition_type):
+    """
+    Floors timestamps to the start of their partition.
+
+    parameters:
+    -----------
+    timestamps: a pandas series, a DatetimeIndex or a datetime64 array
+    partition_type: the table partition type, ymd, ymdh, ym or y
+
+    return
+    ------
+    a DatetimeIndex of partition start timestamps
+    """
+    if partition_type not in partition_units:
+        raise ValueError("Unknown partition type {}".format(partition_type))
+    values = pd.DatetimeIndex(pd.to_datetime(timestamps)).values
+    # casting to a coarser datetime64 unit truncates to its start
+    starts = values.astype(partition_units[partition_type])
+    return pd.DatetimeIndex(starts.astype(values.dtype))
+
+
+def map_partitions(timestamps, partition_type, func=None):
+    """
+    Maps every timestamp to a value of its partition. The
+    timestamps are floored and factorized in bulk, so func is
+    called once per distinct partition rather than once per row.
+
+    parameters:
+    -----------
+    timestamps: a pandas series, a DatetimeIndex or a datetime64 array
+    partition_type: the table partition type, ymd, ymdh, ym or y
+    func: called with the run date string of each partition,
+          None maps to the run date string itself
+
+    return
+    ------
+    a pandas series aligned on the input series, a numpy object
+    array otherwise. Missing timestamps map to a missing value.
+    """
+    starts = partition_starts(timestamps, partition_type)
+    codes, uniques = pd.factorize(starts)
+    keys = uniques.strftime(timestamp_format)
+    if func is not None:
+        keys = [func(key) for key in keys]
+    # the extra None is picked by the -1 code of missing timestamps
+    values = np.array(list(keys) + [None], dtype=object)[codes]
+    if isinstance(timestamps, pd.Series):
+        return pd.Series(values, index=timestamps.index, name=timestamps.name)
+    return values
+
 
 class MetaUtils(object):
 
@@ -18,6 +105,7 @@ class MetaUtils(object):
     HOUR_PRE = "hour="
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def generate_run_date_path(batch_date):
         dobj = datetime.strptime(batch_date, timestamp_format)
         return "{0}{1}/{2}{3}/{4}{5}".format(
@@ -30,6 +118,7 @@ class MetaUtils(object):
         )
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def generate_run_date_hour_path(batch_date):
         dobj = datetime.strptime(batch_date, timestamp_format)
         return "{0}{1}/{2}{3}/{4}{5}/{6}{7}".format(
@@ -44,6 +133,7 @@ class MetaUtils(object):
         )
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def generate_run_year_month(batch_date):
         dobj = datetime.strptime(batch_date, timestamp_format)
         return "{0}{1}/{2}{3}".format(
@@ -54,13 +144,25 @@ class MetaUtils(object):
         )
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def extract_from_string_with_format(batch_date, tmformat):
         dobj = datetime.strptime(batch_date, timestamp_format)
         return dobj.strftime(tmformat)
 
+    @staticmethod
+    def generate_partition_paths(timestamps, partition_type):
+        """
+        Batch version of the generate_run_* functions, see
+        map_partitions for the accepted timestamps.
+        """
+        return map_partitions(
+            timestamps, partition_type, _partition_formatters(MetaUtils)[partition_type]
+        )
+
 
 class KinesisPartitionFormatter(object):
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def generate_run_date_path(batch_date):
         dobj = datetime.strptime(batch_date, timestamp_format)
         return "{0}/{1}/{2}".format(
@@ -68,6 +170,7 @@ class KinesisPartitionFormatter(object):
         )
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def generate_run_date_hour_path(batch_date):
         dobj = datetime.strptime(batch_date, timestamp_format)
         return "{0}/{1}/{2}/{3}".format(
@@ -78,35 +181,69 @@ class KinesisPartitionFormatter(object):
         )
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def generate_run_year_month(batch_date):
         dobj = datetime.strptime(batch_date, timestamp_format)
         return "{0}/{1}".format(dobj.strftime("%Y"), dobj.strftime("%m"))
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def extract_from_string_with_format(batch_date, tmformat):
         dobj = datetime.strptime(batch_date, timestamp_format)
         return dobj.strftime(tmformat)
 
+    @staticmethod
+    def generate_partition_paths(timestamps, partition_type):
+        """
+        Batch version of the generate_run_* functions, see
+        map_partitions for the accepted timestamps.
+        """
+        return map_partitions(
+            timestamps,
+            partition_type,
+            _partition_formatters(KinesisPartitionFormatter)[partition_type],
+        )
+
+
+def _partition_formatters(formatter):
+
+    # the y partitions keep their historical year/month layout
+    return {
+        "ymd": formatter.generate_run_date_path,
+        "ymdh": formatter.generate_run_date_hour_path,
+        "ym": formatter.generate_run_year_month,
+        "y": formatter.generate_run_year_month,
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _resource_filename(module, filepath):
+
+    return pkg_resources.resource_filename(module, filepath)
+
 
 class SchemaResource(object):
     def __init__(self, module, filepath):
 
         self._module = module
         self._filepath = filepath
-        self._schema_file = pkg_resources.resource_filename(
-            self._module, self._filepath
-        )
+        self._schema_file = _resource_filename(self._module, self._filepath)
 
     def schema_file(self):
         return self._schema_file
 
 
 class Table(object):
-    def __init__(self, dbroot, name, schema=None, partitiontype="ymd"):
+    def __init__(
+        self, dbroot, name, schema=None, partitiontype="ymd", storage_format="avro"
+    ):
+        if storage_format not in storage_formats:
+            raise ValueError("Unknown storage format {}".format(storage_format))
         self._name = name
         self._partition_type = partitiontype
         self._schema_file = schema
         self._rootpath = dbroot
+        self._storage_format = storage_format
 
     @property
     def name(self):
@@ -116,6 +253,14 @@ class Table(object):
     def schema(self):
         return self._schema_file
 
+    @property
+    def partition_type(self):
+        return self._partition_type
+
+    @property
+    def storage_format(self):
+        return self._storage_format
+
     def meta(self):
         return "{}\t{}".format(self.name, self.schema)
 
@@ -189,31 +334,265 @@ class Table(object):
         elif self._partition_type is None:
             return "{0}/{1}".format(self._rootpath, self._name)
 
+    def partition_dates(self, start, end=None):
+        """
+        Returns the run dates, one per partition, covering the
+        start/end window (both inclusive) at the table's partition
+        granularity. A table without partitions has a single run
+        date of None.
+        :param start: a run date string or pd.Timestamp
+        :param end: a run date string or pd.Timestamp, defaults to start
+        :return: a list of run date strings
+        """
+        if self._partition_type is None:
+            return [None]
+
+        start = pd.Timestamp(start)
+        end = start if end is None else pd.Timestamp(end)
+        if self._partition_type == "ymdh":
+            start = start.floor("h")
+        elif self._partition_type == "ymd":
+            start = start.normalize()
+        elif self._partition_type == "ym":
+            start = start.normalize().replace(day=1)
+        elif self._partition_type == "y":
+            start = start.normalize().replace(month=1, day=1)
+
+        offset = partition_offsets[self._partition_type]
+        dates = []
+        while start <= end:
+            dates.append(start.strftime(timestamp_format))
+            start = start + offset
+        return dates
+
+    @property
+    def partition_columns(self):
+        """
+        The names of the partition columns encoded in the path.
+        """
+        return partition_columns.get(self._partition_type, ())
+
+    def partition_values(self, rdate):
+        """
+        Returns the partition column values of a run date as ints.
+        :param rdate: a run date string or pd.Timestamp
+        :return: a dict of partition column to value
+        """
+        if rdate is None:
+            return {}
+        rdate = pd.Timestamp(rdate)
+        return {column: getattr(rdate, column) for column in self.partition_columns}
+
+    def parse_partition_values(self, s3_path, separator="="):
+        """
+        Returns the partition column values encoded in a file path
+        of the table, e.g. year=2020/month=01 gives year 2020 and
+        month 1.
+        :param s3_path: a full s3 path under the table
+        :param separator: the separator between a column and its value
+        :return: a dict of partition column to value
+        """
+        values = {}
+        columns = self.partition_columns
+        for segment in s3_path.split("/"):
+            column, found, value = segment.partition(separator)
+            if found and column in columns:
+                values[column] = self._partition_value(value)
+        return values
+
+    @staticmethod
+    def _partition_value(value):
+        return int(value)
+
+    @staticmethod
+    def coerce_partition_filter(value, filter_value):
+        """
+        Returns the partition value and the value of a filter on
+        its column as a comparable pair, the filter value converted
+        to int like the path values are, e.g. "01" to 1.
+        :param value: a partition value, see partition_values
+        :param filter_value: the value of a (column, op, value) filter
+        :return: the pair to compare
+        """
+        try:
+            if isinstance(filter_value, float) and not filter_value.is_integer():
+                raise ValueError(filter_value)
+            return value, int(filter_value)
+        except (TypeError, ValueError):
+            raise ValueError(
+                "Can not compare the partition value {!r} with {!r}".format(
+                    value, filter_value
+                )
+            )
+
+    def partition_range(self, start, end=None, existing_only=False, max_workers=16):
+        """
+        Returns the partitions covering the start/end window (both
+        inclusive) at the table's partition granularity.
+        :param start: a run date string or pd.Timestamp
+        :param end: a run date string or pd.Timestamp, defaults to start
+        :param existing_only: drops the partitions without any object,
+                              listing each parent prefix once
+        :param max_workers: the number of parent prefixes listed concurrently
+        :return: a list of (run date, partition path) tuples
+        """
+        partitions = [
+            (rdate, self.path(rdate)) for rdate in self.partition_dates(start, end)
+        ]
+        if not existing_only:
+            return partitions
+
+        existing = set(
+            filter_existing_s3_prefixes([path for _, path in partitions], max_workers)
+        )
+        return [(rdate, path) for rdate, path in partitions if path in existing]
+
+    def scan(
+        self,
+        start,
+        end=None,
+        columns=None,
+        filter=None,
+        chunk_rows=100000,
+        max_workers=4,
+        use_manifest=False,
+        partition_columns=False,
+        prefetch_chunks=2,
+    ):
+        """
+        Returns a lazy iterator of dataframes of chunk_rows rows over
+        the partitions in the start/end window, with the columns
+        projected and the rows filtered. Nothing is fetched until it
+        is iterated, see s3api.scan_table.
+
+        Example:
+        ```
+        for df in table.scan("2020-01-01", "2020-03-31", ["id", "amount"],
+                             filter=[("amount", ">", 100)]):
+            process(df)
+        ```
+        :param start: the first run date of the window
+        :param end: the last run date of the window, defaults to start
+        :param columns: a list of columns to project
+        :param filter: a list of (column, op, value) tuples, or a
+                       function(df) returning a boolean mask
+        :param chunk_rows: the number of rows of each dataframe
+        :param max_workers: the number of files decoded concurrently
+        :param use_manifest: plan the files from partition manifests
+        :param partition_columns: add the partition columns of the
+                                  paths as categoricals
+        :param prefetch_chunks: the decoded chunks buffered per file
+        :return: a generator of panda dataframes
+        """
+        return scan_table(
+            self,
+            start,
+            end,
+            columns,
+            filter,
+            chunk_rows,
+            max_workers,
+            use_manifest,
+            partition_columns,
+            prefetch_chunks,
+        )
+
+    def partition_keys(self, timestamps):
+        """
+        Returns the run date of the partition of every timestamp.
+        :param timestamps: a pandas series, a DatetimeIndex or a
+                           datetime64 array
+        :return: run date strings, see map_partitions
+        """
+        return map_partitions(timestamps, self._partition_type)
+
+    def paths(self, timestamps):
+        """
+        Batch version of path, returns the partition path of every
+        timestamp. path is only called once per distinct partition.
+        :param timestamps: a pandas series, a DatetimeIndex or a
+                           datetime64 array
+        :return: partition paths, see map_partitions
+        """
+        return map_partitions(timestamps, self._partition_type, self.path)
+
+    def is_partition_closed(self, rdate, grace_period=pd.Timedelta(hours=1)):
+        """
+        Returns True when the partition of the run date ended more
+        than grace_period ago, so no more files are expected in it.
+        :param rdate: a run date string or pd.Timestamp
+        :param grace_period: the delay allowed for late files
+        :return:
+        """
+        if self._partition_type is None or rdate is None:
+            return False
+
+        partition_start = pd.Timestamp(self.partition_dates(rdate)[0])
+        partition_end = partition_start + partition_offsets[self._partition_type]
+        now = pd.Timestamp.now(tz="UTC").tz_localize(None)
+        return partition_end + grace_period < now
+
     def get_table_schema_column_list(self):
 
-        with open(self.schema, "r") as fin:
-            schema_json = json.load(fin)
-            columns = [str(x["name"]) for x in schema_json["fields"]]
-        return columns
+        return list(schema_registry.get(self.schema).columns)
+
+    def get_table_schema(self):
+        """
+        Returns the avro schema dict of the table, loaded once
+        by the schema registry. It must not be changed.
+        :return:
+        """
+        return schema_registry.get(self.schema).schema
+
+    def get_compiled_schema(self, columns=None):
+        """
+        Returns the fastavro parsed schema of the table, projected
+        on the columns when they are given.
+        :param columns: a list of columns, None for every column
+        :return:
+        """
+        return schema_registry.get(self.schema).projection(columns)[1]
+
+    def get_table_dtypes(self):
+        """
+        Returns the pandas dtype of each column of the table.
+        :return:
+        """
+        return dict(schema_registry.get(self.schema).dtypes)
 
 
 class S3Table(Table):
-    def __init__(self, dbroot, name, schema=None, partition_type="ymd"):
+    def __init__(
+        self, dbroot, name, schema=None, partition_type="ymd", storage_format="avro"
+    ):
 
-        super(S3Table, self).__init__(dbroot, name, schema, partition_type)
+        super(S3Table, self).__init__(
+            dbroot, name, schema, partition_type, storage_format
+        )
 
 
 class S3TableWithPartition(Table):
-    def __init__(self, dbroot, name, partition_descritor, schema=None):
+    def __init__(
+        self, dbroot, name, partition_descritor, schema=None, storage_format="avro"
+    ):
 
         # initialize with partition_type as None for base
         # class behavior
-        super(S3TableWithPartition, self).__init__(dbroot, name, schema)
+        super(S3TableWithPartition, self).__init__(
+            dbroot, name, schema, storage_format=storage_format
+        )
         # carry the tuple for partition here.
         # kind of overrides the base class behavior
         self._partition_descriptor = partition_descritor
         self._partition_vals = None
         self._attached_path = None
+        self._partitions = None
+        # the Database the table is registered in, if any
+        self._database = None
+
+    @property
+    def partition_descriptor(self):
+        return self._partition_descriptor
 
     def path_by_vals(self, partition_vals, separator="="):
         """
@@ -236,6 +615,85 @@ class S3TableWithPartition(Table):
         bucket, key = parse_s3_path(path)
         return bucket, key
 
+    @property
+    def partition_columns(self):
+        return tuple(self._partition_descriptor)
+
+    def partition_values(self, rdate):
+        # the partitions are not dated
+        return {}
+
+    @staticmethod
+    def _partition_value(value):
+        # the values are kept as the strings of the path
+        return value
+
+    @staticmethod
+    def coerce_partition_filter(value, filter_value):
+        """
+        Returns the partition value and the value of a filter on
+        its column as a comparable pair. A number filter compares
+        the path value as a number, so hour=03 matches 3 and
+        hour=10 is above 9; any other filter value compares as a
+        string.
+        :param value: a partition value, a string of the path
+        :param filter_value: the value of a (column, op, value) filter
+        :return: the pair to compare
+        """
+        if isinstance(filter_value, numbers.Number) and not isinstance(
+            filter_value, bool
+        ):
+            try:
+                return float(value), filter_value
+            except ValueError:
+                raise ValueError(
+                    "Can not compare the partition value {!r} with {!r}".format(
+                        value, filter_value
+                    )
+                )
+        return value, str(filter_value)
+
+    def discover_partitions(self, separator="=", max_workers=16):
+        """
+        Finds the partition value tuples that exist under the table
+        root, see s3api.discover_s3_partitions. The result is kept
+        in the partitions property.
+        :param separator: the separator between a column and its value
+        :param max_workers: the number of concurrent listings
+        :return: a list of dicts with the partition "values", its
+                 "path", and its "files" and "bytes" totals
+        """
+        self._partitions = discover_s3_partitions(
+            self.path(), self._partition_descriptor, separator, max_workers
+        )
+        return self._partitions
+
+    @property
+    def partitions(self):
+        """
+        The partitions found by the last discovery, None before it.
+        """
+        return self._partitions
+
+    def get_partitions(self, refresh=False, max_age=None, max_workers=16):
+        """
+        Returns the partitions of the table, discovered on S3 only
+        when they are not known yet. A table registered in a
+        Database goes through Database.get_partitions, so the
+        discoveries stored in its catalog are reused.
+        :param refresh: a flag indicates whether to discover again
+        :param max_age: the seconds a catalog discovery stays valid
+        :param max_workers: the number of concurrent listings
+        :return: a list of dicts with the partition "values", its
+                 "path", and its "files" and "bytes" totals
+        """
+        database = self._database
+        if database is not None and database.get_table(self.name) is self:
+            return database.get_partitions(self.name, refresh, max_age, max_workers)
+        if refresh or self._partitions is None:
+            return self.discover_partitions(max_workers=max_workers)
+        return self._partitions
+
     def attach(self, partition_vals, separator="="):
 
         self._partition_vals = partition_vals
@@ -249,9 +707,35 @@ class S3TableWithPartition(Table):
 
 
 class KinesisTable(S3Table):
-    def __init__(self, dbroot, name, schema=None, partition_type="ymdh"):
+    def __init__(
+        self, dbroot, name, schema=None, partition_type="ymdh", storage_format="avro"
+    ):
+
+        super(KinesisTable, self).__init__(
+            dbroot,
+            name,
+            schema,
+            partition_type=partition_type,
+            storage_format=storage_format,
+        )
 
-        super(KinesisTable, self).__init__(dbroot, name, partition_type=partition_type)
+    def parse_partition_values(self, s3_path, separator="="):
+        """
+        Returns the partition column values of a file path of the
+        table, which holds them positionally, e.g. 2020/01/02/03.
+        :param s3_path: a full s3 path under the table
+        :param separator: unused, kinesis paths have no column names
+        :return: a dict of partition column to value
+        """
+        root = self.path().rstrip("/") + "/"
+        if not s3_path.startswith(root):
+            return {}
+        segments = s3_path[len(root) :].split("/")
+        return {
+            column: int(value)
+            for column, value in zip(self.partition_columns, segments)
+            if value.isdigit()
+        }
 
     def path(self, rdate=None):
 
@@ -294,18 +778,18 @@ class KinesisTable(S3Table):
 
 
 class Database(object):
-
     """
     A database is a collection of table & metadata
     """
 
-    def __init__(self, name, rootpath):
+    def __init__(self, name, rootpath, schema_store=None):
 
         self._name = name
         self._db = defaultdict()
-        self._schema_store = None
+        self._schema_store = schema_store
         self._root_path = rootpath
         self._default_partition = "ymd"
+        self._catalog = None
 
     @property
     def name(self):
@@ -319,25 +803,114 @@ class Database(object):
     def schema_store(self):
         return self._schema_store
 
-    def _register_s3_table(self, table_name, fqs_path, custom_partition_type):
+    @property
+    def schema_registry(self):
+        return schema_registry
+
+    @property
+    def catalog(self):
+        return self._catalog
+
+    def attach_catalog(self, catalog):
+        """
+        Persists the database and its tables in the catalog, the
+        tables registered from now on are written through to it.
+        :param catalog: an s3catalog.SQLiteCatalog
+        :return:
+        """
+        self._catalog = catalog
+        catalog.put_database(
+            self._name, self._root_path, self._default_partition, self._schema_store
+        )
+        for table_object in self._db.values():
+            self._persist_table(table_object)
+
+    def _bind_table(self, table_object):
+
+        self._db[table_object.name] = table_object
+        if isinstance(table_object, S3TableWithPartition):
+            table_object._database = self
+
+    def _persist_table(self, table_object):
+
+        if self._catalog is not None:
+            self._catalog.put_table(self._name, **_table_row(table_object))
+
+    def add_table(self, table_object):
+        """
+        Registers a Table, KinesisTable or S3TableWithPartition
+        object under its name.
+        :param table_object:
+        :return:
+        """
+        self._bind_table(table_object)
+        self._persist_table(table_object)
+
+    def _register_s3_table(
+        self, table_name, fqs_path, custom_partition_type, storage_format="avro"
+    ):
 
         default_partition_type = self.partition_type
         if custom_partition_type:
             table_object = Table(
-                self.root_path, table_name, fqs_path, custom_partition_type
+                self.root_path,
+                table_name,
+                fqs_path,
+                custom_partition_type,
+                storage_format,
             )
         else:
             table_object = Table(
-                self.root_path, table_name, fqs_path, default_partition_type
+                self.root_path,
+                table_name,
+                fqs_path,
+                default_partition_type,
+                storage_format,
             )
 
-        self._db[table_name] = table_object
+        self.add_table(table_object)
 
-    def register_table(self, table_name, schema, custom_partition_type=None):
+    def register_table(
+        self, table_name, schema, custom_partition_type=None, storage_format="avro"
+    ):
 
         # make the fully qualified schema path
         fqs_path = os.path.join(self.schema_store, schema)
-        return self._register_s3_table(table_name, fqs_path, custom_partition_type)
+        return self._register_s3_table(
+            table_name, fqs_path, custom_partition_type, storage_format
+        )
+
+    def get_partitions(self, table, refresh=False, max_age=None, max_workers=16):
+        """
+        Returns the partitions of an S3TableWithPartition. They
+        are discovered on S3 once and then served from the table,
+        or from the catalog when one is attached.
+        :param table: the table name
+        :param refresh: a flag indicates whether to discover again
+        :param max_age: the seconds a catalog discovery stays valid,
+                        None keeps it until the next refresh
+        :param max_workers: the number of concurrent listings
+        :return: a list of dicts with the partition "values", its
+                 "path", and its "files" and "bytes" totals
+        """
+        table_object = self._db[table]
+        if not refresh:
+            if table_object.partitions is not None:
+                return table_object.partitions
+            if self._catalog is not None:
+                partitions = self._catalog.get_partitions(self._name, table, max_age)
+                if partitions is not None:
+                    for partition in partitions:
+                        partition["path"] = table_object.path_by_vals(
+                            partition["values"]
+                        )
+                    table_object._partitions = partitions
+                    return partitions
+
+        partitions = table_object.discover_partitions(max_workers=max_workers)
+        if self._catalog is not None:
+            self._catalog.put_partitions(self._name, table, partitions)
+        return partitions
 
     def get_table(self, table):
         if table in self._db.keys():
@@ -365,6 +938,8 @@ class Database(object):
 
         if table in self._db.keys():
             del self._db[table]
+            if self._catalog is not None:
+                self._catalog.delete_table(self._name, table)
 
     def isPartitionNone(self):
 
@@ -403,10 +978,51 @@ class Metastore(object):
     # catalog of databases
     metastore = defaultdict()
 
-    def __init__(self, name):
-
+    def __init__(self, name, catalog=None):
+        """
+        :param name: the metastore name
+        :param catalog: an optional persistent catalog, a SQLite file
+                        path or an s3catalog.SQLiteCatalog. Databases
+                        are loaded from it on first lookup.
+        """
         self._metastore_name = name
         self._schema_store = None
+        if isinstance(catalog, str):
+            catalog = SQLiteCatalog(catalog)
+        self._catalog = catalog
+
+    @property
+    def catalog(self):
+        return self._catalog
+
+    def _lookup(self, name):
+        """
+        Returns the registered database, loading it from the
+        catalog on first lookup.
+        """
+        if name not in self.metastore and self._catalog is not None:
+            self._load_database(name)
+        return self.metastore[name]
+
+    def _load_database(self, name):
+
+        row = self._catalog.get_database(name)
+        if row is None:
+            return
+        dbimpl = Database(name, row["root_path"], row["schema_store"])
+        dbimpl._default_partition = row["default_partition"]
+        for table_row in self._catalog.get_tables(name):
+            dbimpl._bind_table(_table_from_row(table_row))
+        dbimpl._catalog = self._catalog
+        self.metastore[name] = dbimpl
+
+    @property
+    def schema_registry(self):
+        """
+        The registry of parsed table schemas, shared by every
+        database and by the s3api readers and writers.
+        """
+        return schema_registry
 
     def metainfo(self, database):
 
@@ -417,10 +1033,12 @@ class Metastore(object):
     def register_database(self, name, impl):
 
         self.metastore[name] = impl
+        if self._catalog is not None:
+            impl.attach_catalog(self._catalog)
         return
 
     def get_database(self, name):
-        return self.metastore[name]
+        return self._lookup(name)
 
     def list_databases(self):
         """
@@ -433,28 +1051,78 @@ class Metastore(object):
             )
         )
         print("{0}\t{1}\t{2}\t{3}\n".format("DataBase", "Table", "Path", "Schema"))
+        if self._catalog is not None:
+            for name in self._catalog.list_databases():
+                self._lookup(name)
         for db, impl in self.metastore.items():
             impl.show()
         return
 
-    def register_table(self, db_name, table_name, schema, custom_parition_type=None):
+    def register_table(
+        self,
+        db_name,
+        table_name,
+        schema,
+        custom_parition_type=None,
+        storage_format="avro",
+    ):
         """
 
         :param db_name:
         :param table_name:
         :param schema:
         :param custom_parition_type:
+        :param storage_format: avro or parquet
         :return:
         """
-        dbimpl = self.metastore[db_name]
-        dbimpl.register_table(table_name, schema, custom_parition_type)
+        dbimpl = self._lookup(db_name)
+        dbimpl.register_table(table_name, schema, custom_parition_type, storage_format)
         return
 
     def get_catalog(self, name):
-        return self.metastore[name]
+        return self._lookup(name)
 
     def get_table(self, catalog_name, table_name):
         """
         Adding alternative to access table object as a class method
         """
         return self.get_catalog(catalog_name).tbl[table_name]
+
+
+# table classes by the kind name stored in the catalog
+table_kinds = {
+    cls.__name__: cls for cls in (Table, S3Table, KinesisTable, S3TableWithPartition)
+}
+
+
+def _table_row(table_object):
+
+    return {
+        "name": table_object.name,
+        "kind": type(table_object).__name__,
+        "root_path": table_object._rootpath,
+        "schema": table_object.schema,
+        "partition_type": table_object.partition_type,
+        "partition_descriptor": getattr(table_object, "partition_descriptor", None),
+        "storage_format": table_object.storage_format,
+    }
+
+
+def _table_from_row(row):
+
+    table_class = table_kinds[row["kind"]]
+    if table_class is S3TableWithPartition:
+        return S3TableWithPartition(
+            row["root_path"],
+            row["name"],
+            row["partition_descriptor"],
+            row["schema"],
+            storage_format=row["storage_format"],
+        )
+    return table_class(
+        row["root_path"],
+        row["name"],
+        row["schema"],
+        row["partition_type"],
+        storage_format=row["storage_format"],
+    )
@@ -0,0 +1,339 @@
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import fastavro
+import pandas as pd
+from avrocodec import avro_dtype_map, avro_numpy_dtypes, schema_registry
+from s3api import parse_s3_path, upload_file_to_s3
+from s3manifest import (
+    column_stats,
+    manifest_entry,
+    merge_column_stats,
+    write_partition_manifest,
+)
+from s3metastore import S3TableWithPartition, timestamp_format
+
+from shared.awsclients import get_client
+from shared.etlexceptions import GPExpTaskException
+from shared.utils import chunked
+
+
+class _PartitionFile(object):
+    """
+    The avro file being written for one partition. fastavro only
+    keeps the current block (sync_interval bytes) in memory, the
+    rest goes to a local file.
+    """
+
+    def __init__(self, local_path, s3_path, parsed_schema, codec, sync_interval):
+
+        self.local_path = local_path
+        self.s3_path = s3_path
+        self._fo = open(local_path, "wb")
+        self._writer = fastavro.write.Writer(
+            self._fo, parsed_schema, codec=codec, sync_interval=sync_interval
+        )
+        self.rows = 0
+        self.stats = None
+
+    def write(self, records):
+
+        for record in records:
+            self._writer.write(record)
+        self.rows += len(records)
+
+    def add_stats(self, df):
+
+        self.stats = merge_column_stats(self.stats, column_stats(df))
+
+    def size(self):
+        # bytes on disk plus the current, not yet compressed, block
+        return self._fo.tell() + self._writer.io.tell()
+
+    def close(self):
+
+        self._writer.flush()
+        self._fo.close()
+
+
+class PartitionedAvroWriter(object):
+    """
+    Writes dataframes or record iterators to the partitions of a
+    metastore table as avro files encoded with the table's schema.
+
+    Rows of a Table (or KinesisTable) are routed to Table.path(rdate)
+    by their time_column, or all go to the partition of rdate. Rows
+    of an S3TableWithPartition are routed to path_by_vals by the
+    columns named in its partition descriptor, or all go to
+    partition_vals; a row without a value to route it by raises a
+    ValueError. Numeric columns are cast to the dtypes of the schema
+    before encoding. Files are rolled at target_file_size and each
+    finished file is uploaded in the background while encoding goes
+    on. Memory stays bounded by buffer_size per open partition, plus
+    route_batch_size records when an iterator is routed by column.
+
+    With write_manifest the row count and column min/max of every
+    file are tracked and the partition manifests are updated on
+    close, see s3manifest.
+
+    Example:
+    ```
+    with PartitionedAvroWriter(table, time_column="event_time") as writer:
+        for df in chunks:
+            writer.write(df)
+    ```
+    """
+
+    def __init__(
+        self,
+        table,
+        schema=None,
+        time_column=None,
+        target_file_size=128 * 1024 * 1024,
+        buffer_size=1024 * 1024,
+        codec="deflate",
+        max_upload_workers=4,
+        file_prefix="part",
+        write_manifest=False,
+        route_batch_size=10000,
+    ):
+
+        if write_manifest and isinstance(table, S3TableWithPartition):
+            raise ValueError("Manifests are only written for date partitioned tables")
+        self._table = table
+        schema = schema or table.schema
+        if isinstance(schema, dict):
+            self._parsed_schema = fastavro.parse_schema(schema)
+        else:
+            self._parsed_schema = schema_registry.get(schema).parsed
+        numeric_dtypes = {d for dtypes in avro_numpy_dtypes.values() for d in dtypes}
+        self._dtypes = {
+            column: dtype
+            for column, dtype in avro_dtype_map(schema).items()
+            if dtype in numeric_dtypes
+        }
+        self._time_column = time_column
+        self._target_file_size = target_file_size
+        self._buffer_size = buffer_size
+        self._codec = codec
+        self._file_prefix = "{}-{}".format(file_prefix, uuid.uuid4().hex[:12])
+        self._max_pending = 2 * max_upload_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_upload_workers)
+        self._tmpdir = tempfile.mkdtemp(prefix="avro_writer_")
+        self._files = {}
+        self._file_seq = 0
+        self._pending = []
+        self._uploaded = []
+        self._errors = {}
+        self._write_manifest = write_manifest
+        self._route_batch_size = route_batch_size
+        self._manifest_entries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(wait=exc_type is None)
+
+    def _partition_path(self, key):
+
+        if isinstance(self._table, S3TableWithPartition):
+            return self._table.path_by_vals(key)
+        return self._table.path(key)
+
+    def _apply_schema_dtypes(self, df):
+        """
+        Casts the numeric columns of the dataframe to the dtypes of
+        the schema, e.g. a nullable int column that pandas holds as
+        float64, whose values fastavro rejects for an int field.
+        """
+        casts = {
+            column: dtype
+            for column, dtype in self._dtypes.items()
+            if column in df.columns and df[column].dtype != dtype
+        }
+        return df.astype(casts) if casts else df
+
+    def _route(self, data, rdate, partition_vals):
+        """
+        Returns (partition key, records) pairs for the data. Raises
+        a ValueError when a row has no value to route it by.
+        """
+        if rdate is not None:
+            return [(pd.Timestamp(rdate).strftime(timestamp_format), data)]
+        if partition_vals is not None:
+            return [(tuple(partition_vals), data)]
+
+        if isinstance(self._table, S3TableWithPartition):
+            columns = list(self._table.partition_descriptor)
+        elif self._time_column is not None:
+            columns = [self._time_column]
+        else:
+            raise ValueError("Either rdate or a time_column is needed to route rows")
+
+        if len(data) == 0:
+            return []
+
+        if isinstance(self._table, S3TableWithPartition):
+            missing = data[columns].isna().any(axis=1)
+            keys = data[columns].astype(str).apply(tuple, axis=1)
+        else:
+            keys = self._table.partition_keys(data[self._time_column])
+            missing = keys.isna()
+        # groupby would silently drop the rows without a key
+        if missing.any():
+            raise ValueError(
+                "{} rows have no value in {} to route them to a partition".format(
+                    missing.sum(), columns
+                )
+            )
+        return [(key, group) for key, group in data.groupby(keys, sort=True)]
+
+    @staticmethod
+    def _to_records(data):
+
+        if isinstance(data, pd.DataFrame):
+            data = data.astype(object).where(data.notna(), None)
+            return data.to_dict("records")
+        return data
+
+    def write(self, data, rdate=None, partition_vals=None):
+        """
+        Encodes the rows of data into their partitions.
+
+        parameters:
+        -----------
+        data: a pandas dataframe or an iterator of record dicts
+        rdate: the run date of the Table partition of every row
+        partition_vals: the partition values of every row of an
+                        S3TableWithPartition
+        """
+        if not isinstance(data, pd.DataFrame):
+            if rdate is None and partition_vals is None:
+                # route the records route_batch_size at a time, so a
+                # stream is never loaded whole
+                for batch in chunked(data, self._route_batch_size):
+                    self.write(pd.DataFrame(batch))
+                return
+        else:
+            data = self._apply_schema_dtypes(data)
+        for key, rows in self._route(data, rdate, partition_vals):
+            offset = 0
+            # check the file size every few records to roll on time
+            for records in chunked(self._to_records(rows), 1000):
+                partition_file = self._files.get(key)
+                if partition_file is None:
+                    partition_file = self._open_file(key)
+                partition_file.write(records)
+                if self._write_manifest:
+                    if isinstance(rows, pd.DataFrame):
+                        # the original dtypes, not the record objects
+                        chunk = rows.iloc[offset : offset + len(records)]
+                    else:
+                        chunk = pd.DataFrame(records)
+                    partition_file.add_stats(chunk)
+                offset += len(records)
+                if partition_file.size() >= self._target_file_size:
+                    self._roll(key)
+
+    def _open_file(self, key):
+
+        self._file_seq += 1
+        filename = "{}-{:05d}.avro".format(self._file_prefix, self._file_seq)
+        partition_file = _PartitionFile(
+            os.path.join(self._tmpdir, filename),
+            "{}/{}".format(self._partition_path(key).rstrip("/"), filename),
+            self._parsed_schema,
+            self._codec,
+            self._buffer_size,
+        )
+        self._files[key] = partition_file
+        return partition_file
+
+    def _roll(self, key):
+        """
+        Closes the partition's file and uploads it in the background.
+        """
+        partition_file = self._files.pop(key)
+        partition_file.close()
+        # bound the finished files waiting on local disk
+        while len(self._pending) >= self._max_pending:
+            self._collect(self._pending.pop(0))
+        future = self._executor.submit(self._upload, partition_file)
+        self._pending.append((key, partition_file.s3_path, future))
+
+    def _upload(self, partition_file):
+
+        try:
+            size = os.path.getsize(partition_file.local_path)
+            upload_file_to_s3(partition_file.local_path, partition_file.s3_path)
+        finally:
+            os.remove(partition_file.local_path)
+        if not self._write_manifest:
+            return None
+
+        bucket, path = parse_s3_path(partition_file.s3_path)
+        etag = get_client("s3").head_object(Bucket=bucket, Key=path)["ETag"]
+        return manifest_entry(
+            partition_file.s3_path,
+            size,
+            etag,
+            partition_file.rows,
+            partition_file.stats,
+        )
+
+    def _collect(self, pending):
+
+        key, s3_path, future = pending
+        try:
+            entry = future.result()
+            self._uploaded.append(s3_path)
+        except Exception as err:
+            logging.error("Failed to upload {}: {!r}".format(s3_path, err))
+            self._errors[s3_path] = err
+            return
+        if entry is not None:
+            self._manifest_entries.setdefault(key, []).append(entry)
+
+    def close(self, wait=True):
+        """
+        Flushes every open partition file and waits for the uploads.
+
+        parameters:
+        -----------
+        wait: False drops the open files without uploading them
+
+        return
+        ------
+        the list of uploaded files in full s3 path
+        """
+        if wait:
+            for key in list(self._files.keys()):
+                self._roll(key)
+        for partition_file in self._files.values():
+            partition_file.close()
+        self._files = {}
+
+        for pending in self._pending:
+            self._collect(pending)
+        self._pending = []
+        self._executor.shutdown(wait=True)
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+        # the uploaded files are listed even when others failed
+        for key, entries in sorted(self._manifest_entries.items()):
+            write_partition_manifest(self._table, key, entries)
+        self._manifest_entries = {}
+
+        if self._errors:
+            raise GPExpTaskException(
+                "Failed to upload {} files of {}".format(
+                    len(self._errors), self._table.name
+                ),
+                errors=self._errors,
+            )
+        return self._uploaded
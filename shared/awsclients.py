@@ -0,0 +1,159 @@
+"""A registry of boto3 clients shared across the api modules.
+
+Creating a boto3 client re-reads the credentials and the endpoint
+metadata and opens a new connection pool, so the clients are created
+lazily once per (service, region, endpoint) and reused. Clients are
+thread safe and shared by every thread; resources are not, so they
+are cached per thread.
+
+Example:
+```
+s3 = get_client("s3")
+set_endpoint("s3", "http://localhost:5000")  # e.g. moto server
+```
+"""
+
+import os
+import threading
+
+import boto3
+import botocore.config
+
+_lock = threading.RLock()
+_local = threading.local()
+_session = None
+_clients = {}
+_endpoints = {}
+_owner_pid = os.getpid()
+# bumped on every reset so other threads drop their resources too
+_generation = 0
+_client_config = {
+    "max_pool_connections": 50,
+    "retries": {"max_attempts": 10, "mode": "adaptive"},
+}
+
+
+def configure_clients(max_pool_connections=None, retries=None, **config):
+    """Sets the botocore config used for every new client and drops
+    the clients created so far.
+
+    Args:
+        max_pool_connections: (int) connections kept open per client
+        retries: (dict) botocore retry config, e.g. {"mode": "standard"}
+        config: any other botocore.config.Config argument
+    """
+    with _lock:
+        if max_pool_connections is not None:
+            _client_config["max_pool_connections"] = max_pool_connections
+        if retries is not None:
+            _client_config["retries"] = retries
+        _client_config.update(config)
+        reset_clients()
+
+
+def set_endpoint(service, endpoint_url):
+    """Points every new client of the service at the endpoint, e.g.
+    a local moto server. None restores the AWS endpoint.
+
+    Args:
+        service: (string) the boto3 service name
+        endpoint_url: (string) the endpoint url or None
+    """
+    with _lock:
+        if endpoint_url is None:
+            _endpoints.pop(service, None)
+        else:
+            _endpoints[service] = endpoint_url
+        reset_clients()
+
+
+def get_endpoint(service):
+    """Returns the endpoint registered for the service, None for AWS.
+
+    Args:
+        service: (string) the boto3 service name
+    """
+    return _endpoints.get(service)
+
+
+def get_client_config():
+    """Returns a copy of the botocore config arguments of the clients."""
+    with _lock:
+        return dict(_client_config)
+
+
+def reset_clients():
+    """Drops every cached session, client and resource."""
+    global _session, _owner_pid, _generation
+    with _lock:
+        _session = None
+        _clients.clear()
+        _owner_pid = os.getpid()
+        _generation += 1
+
+
+def _get_session():
+
+    global _session
+    # connection pools must not be shared with a forked child
+    if _owner_pid != os.getpid():
+        reset_clients()
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def _client_key(service, region_name, endpoint_url):
+
+    return service, region_name, endpoint_url or _endpoints.get(service)
+
+
+def get_client(service, region_name=None, endpoint_url=None):
+    """Returns the shared client of the service.
+
+    Args:
+        service: (string) the boto3 service name
+        region_name: (string) the aws region, None for the default one
+        endpoint_url: (string) overrides the registered endpoint
+    """
+    key = _client_key(service, region_name, endpoint_url)
+    with _lock:
+        session = _get_session()
+        client = _clients.get(key)
+        if client is None:
+            client = session.client(
+                service,
+                region_name=region_name,
+                endpoint_url=key[2],
+                config=botocore.config.Config(**_client_config),
+            )
+            _clients[key] = client
+        return client
+
+
+def get_resource(service, region_name=None, endpoint_url=None):
+    """Returns the calling thread's resource of the service. The
+    resource reuses the connection pool settings of the clients.
+
+    Args:
+        service: (string) the boto3 service name
+        region_name: (string) the aws region, None for the default one
+        endpoint_url: (string) overrides the registered endpoint
+    """
+    key = _client_key(service, region_name, endpoint_url)
+    with _lock:
+        session = _get_session()
+        if getattr(_local, "generation", None) != _generation:
+            _local.generation = _generation
+            _local.resources = {}
+        resources = _local.resources
+        resource = resources.get(key)
+        if resource is None:
+            resource = session.resource(
+                service,
+                region_name=region_name,
+                endpoint_url=key[2],
+                config=botocore.config.Config(**_client_config),
+            )
+            resources[key] = resource
+        return resource